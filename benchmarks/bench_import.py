@@ -0,0 +1,52 @@
+'''
+Wall time of importing each backend, and of get_drm_module, in a fresh
+interpreter.  Reports the median of several runs so it can be tracked
+for regressions.
+
+    python benchmarks/bench_import.py [runs]
+'''
+from __future__ import print_function
+import os
+import subprocess
+import sys
+
+import drm
+
+CODE = '''\
+import time
+start = time.perf_counter()
+{0}
+print(time.perf_counter() - start)
+'''
+
+STATEMENTS = [
+    'import drm',
+    'import drm.slurm',
+    'import drm.pbs',
+    'import drm.sge',
+    'import drm.bash',
+    'import drm; drm.get_drm_module()',
+]
+
+
+def measure(statement, runs, env):
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', CODE.format(statement)], env=env)
+        times.append(float(out))
+    return sorted(times)[len(times) // 2]
+
+
+def main(runs=11):
+    env = dict(
+        os.environ, PYTHONPATH=os.path.dirname(drm.__path__[0]),
+        PYTHONDONTWRITEBYTECODE='')
+    env.pop('DRM_BACKEND', None)
+    for statement in STATEMENTS:
+        print('{0:>34}: {1:8.1f} ms'.format(
+            statement, measure(statement, runs, env) * 1e3))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,73 @@
+'''
+Per job cost of rendering resource headers, uncached (a Jinja render per
+job) against the cached __str__, for a few distinct resource shapes, and
+of rendering whole job scripts with the Jinja job template against
+JobTemplate.
+
+    python benchmarks/bench_render.py [jobs]
+'''
+from __future__ import print_function
+import sys
+import time
+from datetime import timedelta
+
+from drm import pbs, sge, slurm
+
+
+def shapes(module):
+    return [
+        module.Resource(),
+        module.Resource(workers=8, memInGB=32),
+        module.Resource(time=timedelta(days=2)),
+        module.MpiResource(workers=64, memInGB=4)
+        if hasattr(module, 'MpiResource') else module.Resource(workers=64),
+    ]
+
+
+def run(resources, jobs, render):
+    start = time.time()
+    for i in range(jobs):
+        render(resources[i % len(resources)])
+    return (time.time() - start) / jobs
+
+
+def uncached(resource):
+    return type(resource).__str__.__wrapped__(resource)
+
+
+def script_kwargs(module):
+    '''
+    The common case, a named job with a resource holding on two jobs
+    '''
+    return dict(
+        shell='/bin/bash',
+        job='ls',
+        name='name',
+        hold=['a', 'b'],
+        workDir='/tmp/work',
+        logDir='/tmp/log',
+        script_name='name',
+        jid_list=['1', '2'],
+        resource=module.Resource(workers=4))
+
+
+def main(jobs=100000):
+    for module in [slurm, pbs, sge]:
+        resources = shapes(module)
+        before = run(resources, jobs, uncached)
+        after = run(resources, jobs, str)
+        print('{0:>6}: {1:8.2f} us/job uncached {2:8.2f} us/job cached'.format(
+            module.__name__.split('.')[-1], before * 1e6, after * 1e6))
+
+    for module in [slurm, pbs, sge]:
+        kwargs = [script_kwargs(module)]
+        jinja = module.get_environment().get_template('job')
+        fast = module.JobTemplate()
+        before = run(kwargs, jobs, lambda kw: jinja.render(**kw))
+        after = run(kwargs, jobs, lambda kw: fast.render(**kw))
+        print('{0:>6}: {1:8.2f} us/script jinja {2:8.2f} us/script fast'.format(
+            module.__name__.split('.')[-1], before * 1e6, after * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,95 @@
+'''
+Compare the old csv/strptime sacct parser with the streaming parser
+on a synthetic sacct dump.
+
+    python benchmarks/bench_sacct.py [rows]
+'''
+from __future__ import print_function
+import csv
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from drm import slurm
+
+STATES = ['COMPLETED', 'FAILED', 'CANCELLED by 0', 'TIMEOUT']
+
+
+def write_dump(fh, rows):
+    '''
+    Every job contributes a job line plus .batch and .extern steps
+    '''
+    submit = '2099-01-01T00:00:00'
+    jobids = []
+    n = 0
+    jobid = 1000
+    while n < rows:
+        jobid += 1
+        state = STATES[jobid % len(STATES)]
+        line = '{0}{1}|{2}|0:0|{3}|{0}{1}\n'
+        fh.write(line.format(jobid, '', state, submit))
+        fh.write(line.format(jobid, '.batch', state, submit))
+        fh.write(line.format(jobid, '.extern', 'COMPLETED', submit))
+        jobids.append(str(jobid))
+        n += 3
+    return jobids
+
+
+def old_parse(waiter, raw_data):
+    _iter = csv.DictReader(
+        raw_data.split('\n'), delimiter='|', fieldnames=waiter._header)
+    start = waiter._MODULE_START_TIME
+    return [
+        line for line in _iter if 'batch' not in line['jobidraw']
+        and datetime.strptime(line['submit'], waiter._time_format) >= start
+    ]
+
+
+def new_parse(waiter, lines):
+    return waiter._latest(lines)
+
+
+def measure(func):
+    '''
+    Time a clean run then trace a second one for its peak memory
+    '''
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    del result
+
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(rows=1000000):
+    fd, path = tempfile.mkstemp(suffix='.sacct')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            jobids = write_dump(fh, rows)
+        waiter = slurm.Waiter(jobids)
+
+        def run_old():
+            with open(path) as fh:
+                return old_parse(waiter, fh.read())
+
+        def run_new():
+            with open(path) as fh:
+                return new_parse(waiter, fh)
+
+        for label, func in [('csv+strptime', run_old), ('streaming', run_new)]:
+            result, elapsed, peak = measure(func)
+            print('{0:>14}: {1:8.3f} s {2:10.1f} MB peak, {3} jobs'.format(
+                label, elapsed, peak / 1e6, len(result)))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,245 @@
+'''
+Benchmarks of the render, submit and poll hot paths of every backend,
+written as JSON so two runs can be compared.
+
+    python benchmarks/bench_suite.py [--quick] [--output run.json]
+    python benchmarks/bench_suite.py --compare before.json after.json
+
+Each result is the best of --repeat runs of a benchmark at one size, as
+seconds per run and microseconds per operation.  Nothing is submitted,
+_submit is replaced by a function returning a fake job id.
+'''
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from drm import bash, pbs, sge, slurm
+
+BACKENDS = [slurm, pbs, sge, bash]
+
+ARRAY_SIZES = [10, 10000, 100000]
+HOLD_SIZES = [10, 1000, 100000]
+SACCT_ROWS = [1000, 10000, 100000, 1000000]
+SUBMIT_JOBS = 1000
+RENDER_JOBS = 10000
+
+
+class FakeProcess(object):
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+
+def backend_name(module):
+    return module.__name__.split('.')[-1]
+
+
+def best(func, repeat):
+    '''
+    Shortest wall time of repeat calls of func
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def resources(module):
+    shapes = [
+        module.Resource(),
+        module.Resource(workers=8, memInGB=32),
+        module.Resource(time=timedelta(days=2)),
+    ]
+    if hasattr(module, 'MpiResource'):
+        shapes.append(module.MpiResource(workers=64, memInGB=4, ppn=8))
+    return shapes
+
+
+def bench_render(module, repeat):
+    shapes = resources(module)
+
+    def uncached():
+        for i in range(RENDER_JOBS):
+            shape = shapes[i % len(shapes)]
+            type(shape).__str__.__wrapped__(shape)
+
+    def cached():
+        for i in range(RENDER_JOBS):
+            str(shapes[i % len(shapes)])
+
+    yield 'render_resource_uncached', RENDER_JOBS, best(uncached, repeat)
+    yield 'render_resource_cached', RENDER_JOBS, best(cached, repeat)
+
+
+def submitter(module, directory):
+    '''
+    A Submitter of module with its own name registries that does not
+    run submit_cmd
+    '''
+    ids = itertools.count(1)
+
+    class Submitter(module.Submitter):
+        _JOB_NAME_TO_ID = {}
+        _NO_NAME_JOBS = set()
+        _RESERVED_NAMES = set()
+        _SKIPPED_NAMES = set()
+
+        def _submit(self, script_fp):
+            return FakeProcess(str(next(ids)))
+
+    return Submitter(script=directory, log=directory)
+
+
+def bench_submit(module, repeat, directory):
+    submit = submitter(module, directory)
+    resource = module.Resource(workers=4)
+
+    def run():
+        for i in range(SUBMIT_JOBS):
+            submit.submit_job('ls', hold=['a', 'b'], resource=resource)
+
+    yield 'submit_job', SUBMIT_JOBS, best(run, repeat)
+
+
+def bench_array(module, repeat, sizes):
+    if not hasattr(module, 'JobArray'):
+        return
+    for size in sizes:
+        array = module.JobArray(['echo {0}'.format(i) for i in range(size)])
+        yield 'render_array', size, best(lambda: str(array), repeat)
+
+
+def bench_hold(module, repeat, sizes, directory):
+    submit = submitter(module, directory)
+    for size in sizes:
+        names = ['job{0}'.format(i) for i in range(size)]
+        submit._JOB_NAME_TO_ID.clear()
+        submit._JOB_NAME_TO_ID.update((n, str(i)) for i, n in enumerate(names))
+        yield 'map_name_to_jid', size, best(
+            lambda: submit._map_name_to_jid(names), repeat)
+
+
+def sacct_lines(rows):
+    '''
+    sacct -nDP output of rows lines, a job line plus .batch and .extern
+    steps per job, and the ids of the jobs
+    '''
+    lines, jobids = [], []
+    line = '{0}{1}|{2}|0:0|2099-01-01T00:00:00|{0}{1}\n'
+    for jobid in range(1000, 1000 + (rows + 2) // 3):
+        state = 'COMPLETED' if jobid % 4 else 'FAILED'
+        lines += [line.format(jobid, '', state),
+                  line.format(jobid, '.batch', state),
+                  line.format(jobid, '.extern', 'COMPLETED')]
+        jobids.append(str(jobid))
+    return lines[:rows], jobids
+
+
+def bench_sacct(repeat, sizes):
+    for rows in sizes:
+        lines, jobids = sacct_lines(rows)
+
+        class Waiter(slurm.Waiter):
+            def _cmd(self, jobs, _iter=False):
+                return iter(lines)
+
+        def run():
+            Waiter(jobids, chunk_size=len(jobids)).query()
+
+        yield 'sacct_query', rows, best(run, repeat)
+
+
+def run_all(repeat, quick):
+    arrays = ARRAY_SIZES[:2] if quick else ARRAY_SIZES
+    holds = HOLD_SIZES[:2] if quick else HOLD_SIZES
+    rows = SACCT_ROWS[:2] if quick else SACCT_ROWS
+
+    directory = tempfile.mkdtemp(prefix='drm-bench-')
+    results = []
+    try:
+        for module in BACKENDS:
+            for benchmarks in [
+                    bench_render(module, repeat),
+                    bench_submit(module, repeat, directory),
+                    bench_array(module, repeat, arrays),
+                    bench_hold(module, repeat, holds, directory),
+            ]:
+                for name, size, seconds in benchmarks:
+                    results.append(result(name, backend_name(module), size,
+                                          seconds))
+        for name, size, seconds in bench_sacct(repeat, rows):
+            results.append(result(name, 'slurm', size, seconds))
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def result(name, backend, size, seconds):
+    print('{0:>24} {1:>6} {2:>8}: {3:10.2f} us/op'.format(
+        name, backend, size, seconds / size * 1e6), file=sys.stderr)
+    return {
+        'benchmark': name,
+        'backend': backend,
+        'size': size,
+        'seconds': seconds,
+        'us_per_op': seconds / size * 1e6,
+    }
+
+
+def compare(before_fp, after_fp):
+    '''
+    Print after / before time of every benchmark in both runs
+    '''
+    with open(before_fp) as fh:
+        before = json.load(fh)['results']
+    with open(after_fp) as fh:
+        after = json.load(fh)['results']
+
+    def key(r):
+        return r['benchmark'], r['backend'], r['size']
+
+    old = {key(r): r['seconds'] for r in before}
+    for r in after:
+        if key(r) in old:
+            print('{0:>24} {1:>6} {2:>8}: {3:6.2f}x'.format(
+                r['benchmark'], r['backend'], r['size'],
+                r['seconds'] / old[key(r)]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest sizes')
+    parser.add_argument('--output', help='write JSON here, default stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    text = json.dumps(run_all(args.repeat, args.quick), indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
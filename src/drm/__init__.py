@@ -1,18 +1,30 @@
-def get_drm_module():
-    from distutils.spawn import find_executable
-    if find_executable('pbsnodes'):
-        from . import pbs
-        return pbs
+import os
+import importlib
+
+BACKENDS = ['pbs', 'sge', 'slurm', 'slurmrest', 'bash']
+
+# A backend is picked by the first of these commands found on PATH
+_PROBES = [('pbsnodes', 'pbs'), ('qacct', 'sge'), ('sbatch', 'slurm')]
 
-    elif find_executable('qacct'):
-        from . import sge
-        return sge
+_DETECTED = None
+
+
+def get_drm_module():
+    '''
+    The backend module for this machine.  DRM_BACKEND=pbs|sge|slurm|bash
+    skips detection, otherwise PATH is searched once per process and the
+    answer is reused.  slurmrest is never detected, only chosen.
+    '''
+    name = os.environ.get('DRM_BACKEND') or _detect()
+    if name not in BACKENDS:
+        raise ValueError('DRM_BACKEND must be one of {0}, not {1}'.format(
+            ', '.join(BACKENDS), name))
+    return importlib.import_module('.' + name, __name__)
 
-    elif find_executable('sbatch'):
-        from . import slurm
-        return slurm
 
-    else:
-        from . import bash
-        return bash
-    
+def _detect():
+    global _DETECTED
+    if _DETECTED is None:
+        from shutil import which
+        _DETECTED = next((name for cmd, name in _PROBES if which(cmd)), 'bash')
+    return _DETECTED
@@ -0,0 +1,163 @@
+'''
+asyncio versions of Submitter and Waiter.
+
+Scheduler commands are run with asyncio.create_subprocess_exec instead of
+sh so many workflows can share one event loop.  The number of scheduler
+commands in flight at once, per event loop, is capped by MAX_CONCURRENT.
+asyncio and sh are only imported once a coroutine runs.
+'''
+import logging
+import os
+import weakref
+
+import drm.base as base
+import drm.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT = int(os.environ.get('DRM_MAX_CONCURRENT', 16))
+
+_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+class CompletedCommand(object):
+    def __init__(self, stdout, stderr):
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+def _semaphore():
+    import asyncio
+    loop = asyncio.get_event_loop()
+    sem = _SEMAPHORES.get(loop)
+    if sem is None:
+        sem = _SEMAPHORES[loop] = asyncio.Semaphore(MAX_CONCURRENT)
+    return sem
+
+
+async def run_command(args, input=None):
+    '''
+    Run args, with input written to its stdin, and return its decoded
+    output, raising the same exceptions as sh would for a missing command
+    or a non zero exit status
+    '''
+    import asyncio
+    import sh
+    args = [str(a) for a in args]
+    async with _semaphore():
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=None if input is None else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        except FileNotFoundError:
+            raise sh.CommandNotFound(args[0])
+        stdout, stderr = await proc.communicate(
+            None if input is None else input.encode())
+
+    if proc.returncode != 0:
+        raise sh.ErrorReturnCode(' '.join(args), stdout, stderr)
+    return CompletedCommand(stdout.decode(), stderr.decode())
+
+
+class AsyncSubmitter(object):
+    '''
+    Mixin for a backend Submitter, submit_job becomes a coroutine
+    '''
+
+    @metrics.timed('submit_job')
+    async def submit_job(
+            self,
+            job,
+            name=None,
+            hold=None,
+            workDir=None,
+            resource='',
+            inputs=(),
+            outputs=()):
+
+        if not job:
+            return None
+
+        self._reserve([name])
+        try:
+            if isinstance(job, base.JobArray):
+                import asyncio
+                # arrays may be split in several submissions
+                info = await asyncio.get_event_loop().run_in_executor(
+                    None, self._submit_array, job, name, hold, workDir,
+                    resource)
+                self._register(name, info.id)
+                return info
+            job, fingerprint, skipped = self._incremental(
+                job, name, hold, workDir, resource, inputs, outputs)
+            if skipped is not None:
+                return skipped
+            script_fp = self._write_script(job, name, hold, workDir, resource)
+            jobid = await self._submit_script_async(script_fp)
+            self._register(name, jobid)
+        finally:
+            self._release([name])
+        info = base.JobInfo(jobid, script_fp)
+        self._remember(fingerprint, info)
+        return info
+
+    @metrics.timed('submit_cmd')
+    async def _submit_async(self, script_fp):
+        if isinstance(script_fp, base.ScriptText):
+            return await run_command([self.submit_cmd],
+                                     input=script_fp.text())
+        return await run_command([self.submit_cmd, script_fp])
+
+    async def _submit_script_async(self, script_fp):
+        import asyncio
+        import sh
+        governor = self.governor
+        retries = governor.retry_delays() if governor else iter(())
+        while True:
+            if governor is not None:
+                # throttle sleeps, keep it off the event loop
+                await asyncio.get_event_loop().run_in_executor(
+                    None, governor.throttle, self)
+            try:
+                p = await self._submit_async(script_fp)
+            except sh.CommandNotFound as err:
+                logger.warning(str(err))
+                return None
+            except sh.ErrorReturnCode as err:
+                delay = self._retry_delay(err, retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                return self._submitted(script_fp, p)
+
+
+class AsyncWaiter(object):
+    '''
+    Mixin for a backend Waiter, query and wait become coroutines.
+
+    The backend Waiter must provide _query_args, a list of commands to run
+    (empty if there is nothing to ask), and _parse to consume the output
+    of each command.
+    '''
+
+    async def query(self):
+        import asyncio
+        outputs = await asyncio.gather(
+            *[run_command(args) for args in self._query_args()])
+        for p in outputs:
+            self._parse(p.stdout)
+        return self
+
+    async def wait(self):
+        import asyncio
+        delays = self.delays()
+        deadline = self._deadline()
+        while (True):
+            await self.query()
+            delay = self._next_delay(delays, deadline)
+            if delay is None:
+                return self
+            await asyncio.sleep(delay)
@@ -1,16 +1,39 @@
 from builtins import object
+import os
+import re
+import copy
+import gzip
 import uuid
+import fcntl
+import hashlib
 import logging
 import threading
-import sh
+import random
+import time
 import functools
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from past.builtins import basestring
 from datetime import timedelta
-from path import Path
+from shlex import quote
 import attr
 
+import drm.metrics as metrics
+
 logger = logging.getLogger(__name__)
 
+RENDER_CACHE_SIZE = int(os.environ.get('DRM_RENDER_CACHE_SIZE', 256))
+
+# Build job scripts with string joins instead of the Jinja job template
+FAST_RENDER = os.environ.get('DRM_FAST_RENDER', '1') != '0'
+
+# Most tasks per array, by default asked from the scheduler
+MAX_ARRAY_SIZE = os.environ.get('DRM_MAX_ARRAY_SIZE')
+
+# SQLite file every Submitter records its jobs in, see drm.registry
+REGISTRY_PATH = os.environ.get('DRM_REGISTRY')
+
 
 def make_jinja_env(template_dict):
     from jinja2 import Environment, DictLoader
@@ -22,6 +45,59 @@ def make_jinja_env(template_dict):
     return env
 
 
+def lazy_environment(make_environment, template_dict):
+    '''
+    Function returning make_environment(template_dict), built on the
+    first call so jinja2 is only imported once a template is needed
+    '''
+    env = []
+
+    def get_environment():
+        if not env:
+            env.append(make_environment(template_dict))
+        return env[0]
+
+    return get_environment
+
+
+class LazyTemplate(object):
+    '''
+    Class attribute for the template called name in get_environment(),
+    loaded the first time it is read
+    '''
+
+    def __init__(self, get_environment, name):
+        self.get_environment = get_environment
+        self.name = name
+        self._template = None
+
+    def __get__(self, obj, objtype=None):
+        if self._template is None:
+            self._template = self.get_environment().get_template(self.name)
+        return self._template
+
+
+class LazyCommand(object):
+    '''
+    Class attribute for sh.Command(args[0]).bake(*args[1:]), looked up on
+    PATH the first time it is read.  None if the command is not found.
+    '''
+    _missing = object()
+
+    def __init__(self, args):
+        self.args = args
+        self._cmd = self._missing
+
+    def __get__(self, obj, objtype=None):
+        if self._cmd is self._missing:
+            import sh
+            try:
+                self._cmd = sh.Command(self.args[0]).bake(*self.args[1:])
+            except sh.CommandNotFound:
+                self._cmd = None
+        return self._cmd
+
+
 def none_guard_filters(func):
     '''
     Only guards against the first argument being None
@@ -48,15 +124,423 @@ def none_guard_filters(func):
     return wrapper
 
 
+def cached_str(render):
+    '''
+    Decorator for the __str__ of an immutable value.  Renders are kept in
+    an LRU keyed by the value, values that can not be hashed (e.g. a
+    Constraint with a list of features) are rendered every time.
+    '''
+    render = metrics.timed('render_resource')(render)
+    cache = functools.lru_cache(maxsize=RENDER_CACHE_SIZE)(render)
+
+    @functools.wraps(render)
+    def wrapper(self):
+        try:
+            return cache(self)
+        except TypeError:
+            return render(self)
+
+    wrapper.cache = cache
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def scheduler_setting(args, pattern):
+    '''
+    The first group of pattern in the output of the command args (a
+    tuple) as an int, None if the command fails or has no such setting.
+    Each command is run at most once per process.
+    '''
+    out = command_output(args)
+    if out is None:
+        return None
+    m = re.search(pattern, out, re.MULTILINE)
+    return int(m.group(1)) if m else None
+
+
+def command_output(args):
+    '''
+    Output of the command args, None if it is missing or fails
+    '''
+    import sh
+    try:
+        out = sh.Command(args[0])(*args[1:])
+    except (sh.CommandNotFound, sh.ErrorReturnCode):
+        return None
+    out = getattr(out, 'stdout', out)
+    return out.decode() if isinstance(out, bytes) else str(out)
+
+
+def count_pending(args, is_pending):
+    '''
+    Number of lines of the output of args for which is_pending is true,
+    None if the command fails
+    '''
+    out = command_output(args)
+    if out is None:
+        return None
+    return sum(1 for line in out.splitlines() if is_pending(line))
+
+
 class JobInfo(object):
     def __init__(self, id, script):
         self.id = id
         self.script = script
 
 
+class SkippedJobInfo(JobInfo):
+    '''
+    JobInfo of an incremental job that was not submitted because the same
+    job already succeeded, id and script are those of that job
+    '''
+
+    def __init__(self, id, script, fingerprint):
+        super(SkippedJobInfo, self).__init__(id, script)
+        self.fingerprint = fingerprint
+
+
+# the job runs in a subshell so exit and exec in it still reach the marker
+_SUCCESS_MARKER = '''
+)
+drm_status=$?
+if [ $drm_status -eq 0 ]; then touch {0}; fi
+exit $drm_status'''
+
+
+class ScriptText(object):
+    '''
+    A script that was piped to the submit command instead of written to
+    scriptDir, path is where it would have been written
+    '''
+
+    def __init__(self, path, text):
+        self.path = path
+        self._text = text
+
+    def text(self):
+        return self._text
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, str(self.path))
+
+
+class ArchivedScript(ScriptText):
+    '''
+    A piped script kept in a ScriptArchive, read back on demand
+    '''
+
+    def __init__(self, path, archive, offset, length):
+        self.path = path
+        self.archive = archive
+        self.offset = offset
+        self.length = length
+
+    def text(self):
+        return self.archive.read(self.offset, self.length)
+
+
+class ScriptArchive(object):
+    '''
+    Scripts appended to a single gzip file, each as its own gzip member,
+    so that submitting without script files still leaves an audit trail.
+    <path>.index has a line of script name, offset and length per
+    member, a script is read back with one seek.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = '{0}.index'.format(path)
+        self._lock = threading.Lock()
+        self._fh = None
+        self._index = None
+
+    def add(self, path, text):
+        data = gzip.compress(text.encode('utf-8'))
+        name = os.path.basename(str(path))
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, 'ab')
+                self._index = open(self.index_path, 'a')
+            offset = self._fh.tell()
+            self._fh.write(data)
+            self._fh.flush()
+            self._index.write('{0}\t{1}\t{2}\n'.format(name, offset, len(data)))
+            self._index.flush()
+        return ArchivedScript(path, self, offset, len(data))
+
+    def read(self, offset, length):
+        with open(self.path, 'rb') as fh:
+            fh.seek(offset)
+            return gzip.decompress(fh.read(length)).decode('utf-8')
+
+    def __iter__(self):
+        '''
+        (name, text) of every script in the order they were added
+        '''
+        with open(self.index_path) as index:
+            for line in index:
+                name, offset, length = line.rstrip('\n').rsplit('\t', 2)
+                yield name, self.read(int(offset), int(length))
+
+    def close(self):
+        '''
+        Close the files, a later add() opens them again
+        '''
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._index.close()
+                self._fh = self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScriptStore(object):
+    '''
+    Scripts kept under root by the sha256 of their body, so a script
+    rendered again by any Submitter or run using the same scriptDir is
+    written only once.  refs records which job ids use which script and
+    gc() removes scripts that no tracked job uses any more.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.refs_path = os.path.join(str(root), 'refs')
+
+    def put(self, text):
+        '''
+        Path of the script with body text, written atomically if new
+        '''
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        script_fp = self.root.joinpath(digest[:2], digest)
+        try:
+            # a fresh mtime keeps a reused script safe from gc(min_age)
+            os.utime(script_fp)
+            return script_fp
+        except OSError:
+            pass
+        script_fp.parent.makedirs_p()
+        tmp = '{0}.{1}.tmp'.format(script_fp, uuid.uuid4().hex)
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, script_fp)
+        return script_fp
+
+    def ref(self, script_fp, jobids):
+        lines = ''.join('{0}\t{1}\n'.format(os.path.basename(str(script_fp)), j)
+                        for j in jobids if j)
+        if lines:
+            with self._locked_refs() as fh:
+                fh.write(lines)
+
+    def refs(self):
+        '''
+        {digest: set of job ids}
+        '''
+        if not os.path.exists(self.refs_path):
+            return {}
+        with self._locked_refs() as fh:
+            fh.seek(0)
+            return self._parse(fh)
+
+    def gc(self, jobids, min_age=3600):
+        '''
+        Remove scripts not used by any job in jobids and untouched for
+        min_age seconds, refs of other jobs are forgotten.  Returns the
+        removed paths.
+        '''
+        jobids = set(str(j) for j in jobids)
+        self.root.makedirs_p()
+        with self._locked_refs() as fh:
+            fh.seek(0)
+            live = {}
+            for digest, users in self._parse(fh).items():
+                users &= jobids
+                if users:
+                    live[digest] = users
+            fh.seek(0)
+            fh.truncate()
+            fh.write(''.join('{0}\t{1}\n'.format(digest, j)
+                             for digest in sorted(live)
+                             for j in sorted(live[digest])))
+
+            removed = []
+            cutoff = time.time() - min_age
+            for script_fp in self.root.glob('??/*'):
+                digest = script_fp.name.split('.')[0]
+                if digest in live:
+                    continue
+                try:
+                    if os.path.getmtime(script_fp) > cutoff:
+                        continue
+                    os.remove(script_fp)
+                except OSError:
+                    continue
+                removed.append(script_fp)
+            return removed
+
+    def _locked_refs(self):
+        fh = open(self.refs_path, 'a+')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    @staticmethod
+    def _parse(lines):
+        refs = {}
+        for line in lines:
+            digest, sep, jobid = line.rstrip('\n').partition('\t')
+            if sep:
+                refs.setdefault(digest, set()).add(jobid)
+        return refs
+
+
+class ArrayJobInfo(JobInfo):
+    '''
+    JobInfo of a JobArray, which is split into several scheduler arrays
+    of size tasks if it is too large for one.  ids and scripts have an
+    entry per scheduler array, id is the only id of an array that was not
+    split and the list of ids otherwise.  task_id maps the index of a job
+    in the JobArray to its task id on the scheduler.
+    '''
+
+    def __init__(self, ids, scripts, size, length, array_task_id):
+        super(ArrayJobInfo, self).__init__(
+            ids[0] if len(ids) == 1 else list(ids), scripts[0])
+        self.ids = ids
+        self.scripts = scripts
+        self.size = size
+        self._length = length
+        self._array_task_id = array_task_id
+
+    def __len__(self):
+        return self._length
+
+    def task_id(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        array_id = self.ids[index // self.size]
+        if array_id is None:
+            return None
+        return self._array_task_id(array_id, index % self.size)
+
+    def task_ids(self):
+        return [self.task_id(i) for i in range(self._length)]
+
+    def script_of(self, index):
+        return self.scripts[index // self.size]
+
+
+@attr.s(frozen=True, slots=True)
+class TaskResult(object):
+    '''
+    Exit code and start and end epoch seconds of one packed command
+    '''
+    index = attr.ib()
+    exitcode = attr.ib()
+    start = attr.ib()
+    end = attr.ib()
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+
+_PACKED_TASK = '''\
+# packed commands, {workers} at a time
+xargs -0 -n 2 -P {workers} {shell} -c '
+start=$(date +%s.%N)
+{shell} -c "$3"
+code=$?
+printf "%s\\t%s\\t%s\\t%s\\n" "$2" "$code" "$start" "$(date +%s.%N)" >> "$1"
+' packed {results} < {tasks}
+awk -F '\\t' '$2 != 0 {{bad = 1}} END {{exit bad}}' {results}'''
+
+
+def packed_job(tasks_fp, results_fp, workers=1, shell='/bin/bash'):
+    '''
+    Body of a job that runs the commands in tasks_fp on a pool of workers
+    and appends a line of index, exit code, start and end to results_fp
+    per command.  The job fails if any command did.
+    '''
+    return _PACKED_TASK.format(
+        workers=max(1, int(workers or 1)), shell=shell,
+        tasks=quote(str(tasks_fp)), results=quote(str(results_fp)))
+
+
+class PackedJobInfo(JobInfo):
+    '''
+    JobInfo of commands packed into jobs of size commands each.  ids,
+    scripts and result_fps have an entry per job, id is the only id or
+    the list of ids if there are several jobs.
+    '''
+
+    def __init__(self, ids, scripts, result_fps, size, length):
+        super(PackedJobInfo, self).__init__(
+            ids[0] if len(ids) == 1 else list(ids), scripts[0])
+        self.ids = ids
+        self.scripts = scripts
+        self.result_fps = result_fps
+        self.size = size
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def results(self):
+        '''
+        TaskResult of every command that has finished, by index.  If a
+        job was requeued the latest run of a command wins.
+        '''
+        results = {}
+        for results_fp in self.result_fps:
+            if not os.path.exists(results_fp):
+                continue
+            with open(results_fp) as fh:
+                for line in fh:
+                    fields = line.split('\t')
+                    if len(fields) != 4:
+                        continue
+                    index, exitcode = int(fields[0]), int(fields[1])
+                    results[index] = TaskResult(
+                        index, exitcode, float(fields[2]), float(fields[3]))
+        return results
+
+    def failed(self):
+        return sorted(i for i, r in self.results().items() if r.exitcode)
+
+    def unfinished(self):
+        done = self.results()
+        return [i for i in range(self._length) if i not in done]
+
+
+def array_throttle(job):
+    '''
+    The %N suffix of an array range limiting it to N running tasks
+    '''
+    return '%{0}'.format(job.throttle) if job.throttle else ''
+
+
 @attr.s
 class JobArray(object):
+    '''
+    throttle caps the number of tasks running at once.  An array larger
+    than the scheduler allows is split, the parts run side by side unless
+    chain is set, then each part holds on the one before it.  Parts run
+    side by side share the throttle, each gets at least 1.
+    '''
     jobs = attr.ib(default=attr.Factory(list))
+    throttle = attr.ib(default=None)
+    chain = attr.ib(default=False)
 
     def add_job(self, job):
         raise NotImplementedError()
@@ -73,12 +557,152 @@ class JobArray(object):
     def __bool__(self):
         return bool(self.jobs)
 
+    def split(self, size):
+        '''
+        JobArrays of at most size jobs each, in order
+        '''
+        return [
+            attr.evolve(self, jobs=self.jobs[i:i + size])
+            for i in range(0, len(self.jobs), size)
+        ]
+
+    def close(self):
+        pass
+
+
+class IndexedJobArray(object):
+    '''
+    Mixin for a backend JobArray that keeps its commands in files next to
+    the job script instead of in the script itself.
+
+    Each command is appended to <path>.tasks as soon as it is added and
+    its offset and length to <path>.index as a fixed width record, so the
+    driver's memory does not grow with the number of tasks.  The script
+    only holds a few lines that read the task's own record and command
+    with two seeks, however large the array is.
+
+    Subclasses set task_id to the shell variable holding the task index.
+    '''
+    task_id = None
+
+    _record = '{0:15d} {1:15d}\n'
+    _record_size = 32
+    _dispatch = '''\
+set -- $(dd if={index} bs={size} skip={skip} count=1 2>/dev/null)
+eval "$(tail -c +$(($1 + 1)) {tasks} | head -c $2)"
+'''
+
+    def __init__(self, path, jobs=(), throttle=None, chain=False):
+        self.tasks_fp = '{0}.tasks'.format(path)
+        self.index_fp = '{0}.index'.format(path)
+        self.throttle = throttle
+        self.chain = chain
+        self._tasks = open(self.tasks_fp, 'wb')
+        self._index = open(self.index_fp, 'wb')
+        self._first = 0
+        self._count = 0
+        self._offset = 0
+        self.extend(jobs)
+
+    def add_job(self, job):
+        command = str(job).encode('utf-8')
+        self._tasks.write(command)
+        self._index.write(
+            self._record.format(self._offset, len(command)).encode('ascii'))
+        self._offset += len(command)
+        self._count += 1
+
+    def extend(self, jobs):
+        '''
+        Add every job of an iterable, which is consumed lazily
+        '''
+        for job in jobs:
+            self.add_job(job)
+
+    def split(self, size):
+        '''
+        Views of at most size jobs each sharing this array's task files
+        '''
+        arrays = []
+        for start in range(0, self._count, size):
+            view = copy.copy(self)
+            view._first = self._first + start
+            view._count = min(size, self._count - start)
+            arrays.append(view)
+        return arrays
+
+    def flush(self):
+        if not self._tasks.closed:
+            self._tasks.flush()
+            self._index.flush()
+
+    def close(self):
+        self._tasks.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return self._count > 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        self.flush()
+        with open(self.index_fp, 'rb') as fh:
+            fh.seek((self._first + index) * self._record_size)
+            offset, length = fh.read(self._record_size).split()
+        with open(self.tasks_fp, 'rb') as fh:
+            fh.seek(int(offset))
+            return fh.read(int(length)).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def __str__(self):
+        self.flush()
+        skip = self.task_id
+        if self._first:
+            skip = '$(({0} + {1}))'.format(self.task_id, self._first)
+        return self._dispatch.format(
+            index=quote(self.index_fp),
+            size=self._record_size,
+            skip=skip,
+            tasks=quote(self.tasks_fp))
+
+    def __repr__(self):
+        return '{0}({1!r}, {2} jobs)'.format(
+            type(self).__name__, self.tasks_fp[:-len('.tasks')], self._count)
+
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+
+def _abspath(path=None):
+    '''
+    Absolute path.Path of path, the working directory by default.
+    path.py is slow to import so it is only imported once needed.
+    '''
+    from path import Path
+    return Path(path or Path.getcwd()).abspath()
+
 
 def _scalar_to_iter(arg):
     return [arg] if isinstance(arg, basestring) else arg
 
 
-@attr.s
+@attr.s(frozen=True, slots=True, cache_hash=True)
 class Constraint(object):
     features = attr.ib()
 
@@ -89,7 +713,7 @@ class Constraint(object):
         return bool(self.features)
 
 
-@attr.s
+@attr.s(frozen=True, slots=True, cache_hash=True)
 class Resource(object):
     memInGB = attr.ib(default=1)
     workers = attr.ib(default=1)
@@ -100,7 +724,7 @@ class Resource(object):
         raise NotImplementedError()
 
 
-@attr.s
+@attr.s(frozen=True, slots=True, cache_hash=True)
 class MpiResource(object):
     memInGB = attr.ib(default=1)
     workers = attr.ib(default=1)
@@ -114,81 +738,659 @@ class MpiResource(object):
 
 class Submitter(object):
     submit_cmd = None  # String or sh.Command
-    template = None  # Jinja2 template
+    template = None  # Jinja2 template or anything with the same render()
+    array_class = None  # JobArray subclass used to coalesce jobs
+    indexed_array_class = None  # IndexedJobArray subclass for large arrays
+    inline_array_limit = 1000  # larger submit_many arrays are indexed
+    # pipe scripts to submit_cmd instead of writing them to scriptDir, and
+    # if archive is set keep them in one compressed file per Submitter
+    stdin = False
+    archive = False
+    # write each distinct script once to scriptDir/store, named by its hash
+    content_addressed = False
+    # Governor pacing and retrying submissions, None submits right away
+    governor = None
+    # submit errors matching this are retried by the governor
+    transient_error = None
+    # JobRegistry recording submitted jobs, DRM_REGISTRY sets a default
+    registry = None
+    # skip jobs that already succeeded with the same script, see submit_job
+    incremental = False
+    # most tasks per array, None asks the scheduler
+    max_array_size = int(MAX_ARRAY_SIZE) if MAX_ARRAY_SIZE else None
 
     shell = '/bin/bash'
     script_name_join = '-'
     uid_length = 8
+    max_workers = 8  # default thread pool size of submit_parallel
 
     _LOCK = threading.Lock()
     _JOB_NAME_TO_ID = {}
     _NO_NAME_JOBS = set()
+    _RESERVED_NAMES = set()
+    # names of incremental jobs skipped as up to date, holds on them are
+    # satisfied without a dependency
+    _SKIPPED_NAMES = set()
 
     def __init__(self, script=None, log=None):
         '''
         By default batch scripts and job streams are written to working directory
         '''
-        self.scriptDir = Path(script or Path.getcwd()).abspath()
-        self.logDir = Path(log or Path.getcwd()).abspath()
+        self.scriptDir = _abspath(script)
+        self.logDir = _abspath(log)
 
         self.scriptDir.mkdir_p()
         self.logDir.mkdir_p()
 
         self.uid = uuid.uuid4().hex[:self.uid_length]
+        self._script_count = itertools.count()
+        self._archive = None
+        self._fingerprints = {}
+        if self.registry is None and REGISTRY_PATH:
+            from drm.registry import shared
+            self.registry = shared(REGISTRY_PATH)
 
     def get_jobid_from_submit(self, stdout):
         raise NotImplementedError()
 
+    def array_task_id(self, array_id, index):
+        '''
+        Job id of a single task of an array job
+        '''
+        return '{0}_{1}'.format(array_id, index)
+
+    @metrics.timed('submit_job')
     def submit_job(
             self,
             job,
             name=None,
             hold=None,
             workDir=None,
-            resource='', ):
-
+            resource='',
+            inputs=(),
+            outputs=()):
+        '''
+        With incremental set, a job is not submitted again if a job with
+        the same script, inputs and outputs succeeded before, all of its
+        outputs exist and are newer than its inputs, and none of the jobs
+        it holds on was submitted in this process.  A SkippedJobInfo of
+        the earlier job is returned and holds on name are dropped.
+        '''
         if not job:
             return None
 
-        workDir = Path(workDir or Path.getcwd()).abspath()
+        self._reserve([name])
+        return self._submit_reserved(job, name, hold, workDir, resource,
+                                     inputs, outputs)
+
+    def submit_many(self, jobs, hold=None, workDir=None, resource=''):
+        '''
+        Submit many jobs with as few scheduler calls as possible.
+
+        Each entry of jobs is either a job string or a dict of submit_job
+        keyword arguments.  hold, workDir and resource are used for entries
+        that do not set them.  Jobs sharing the same resource, workDir and
+        hold names are submitted together as a single array job.  Holds on
+        names within jobs are only honored if that job is in an earlier group.
+
+        Returns one JobInfo per entry (None for empty jobs), task ids
+        are of the form returned by array_task_id.  Arrays of more than
+        inline_array_limit jobs keep their commands in an indexed task file.
+        '''
+        specs = self._job_specs(jobs, hold, workDir, resource)
+        self._reserve([s['name'] for s in specs if s['job']])
+
+        groups = OrderedDict()
+        for i, spec in enumerate(specs):
+            if not spec['job']:
+                continue
+            key = (str(spec['resource']),
+                   _abspath(spec['workDir']),
+                   frozenset(n for n in _scalar_to_iter(spec['hold'] or []) if n))
+            groups.setdefault(key, []).append(i)
+
+        infos = [None] * len(specs)
+        try:
+            for indices in groups.values():
+                if len(indices) == 1 or self.array_class is None:
+                    for i in indices:
+                        infos[i] = self._submit_reserved(**specs[i])
+                    continue
+
+                first = specs[indices[0]]
+                if (self.indexed_array_class is not None and not self.stdin
+                        and len(indices) > self.inline_array_limit):
+                    array = self.indexed_array()
+                else:
+                    array = self.array_class()
+                try:
+                    for i in indices:
+                        array.add_job(specs[i]['job'])
+                    info = self._submit_array(array, None, first['hold'],
+                                              first['workDir'],
+                                              first['resource'], 'array')
+                finally:
+                    array.close()
+                for index, i in enumerate(indices):
+                    jobid = info.task_id(index)
+                    self._register(specs[i]['name'], jobid)
+                    infos[i] = JobInfo(jobid, info.script_of(index))
+        finally:
+            self._release([s['name'] for s in specs])
+
+        return infos
+
+    def submit_packed(self, jobs, name=None, hold=None, workDir=None,
+                      resource='', pack_size=None):
+        '''
+        Run many short commands inside as few jobs as possible.  Each job
+        runs up to pack_size of jobs (all of them by default) on a pool of
+        resource.workers workers.  The commands are written to a task file
+        in scriptDir and every command's exit code and timing to a results
+        file in logDir, read them back with PackedJobInfo.results().
+        '''
+        jobs = [job for job in jobs if job]
+        if not jobs:
+            return None
+        size = pack_size or len(jobs)
+        packs = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        workers = getattr(resource, 'workers', 1)
+
+        self._reserve([name])
+        try:
+            ids, scripts, result_fps = [], [], []
+            for k, pack in enumerate(packs):
+                script_name = name or 'packed'
+                if len(packs) > 1:
+                    script_name = '{0}.{1}'.format(script_name, k)
+                base_fp = self._script_path(name, script_name)
+                tasks_fp = '{0}.tasks'.format(base_fp)
+                results_fp = self.logDir.joinpath(
+                    '{0}.results'.format(base_fp.name))
+                with open(tasks_fp, 'w') as fh:
+                    for i, job in enumerate(pack, k * size):
+                        fh.write('{0}\0{1}\0'.format(i, job))
+
+                body = packed_job(tasks_fp, results_fp, workers, self.shell)
+                script_fp = self._write_script(body, name, hold, workDir,
+                                               resource, script_name)
+                ids.append(self._submit_script(script_fp))
+                scripts.append(script_fp)
+                result_fps.append(results_fp)
+
+            info = PackedJobInfo(ids, scripts, result_fps, size, len(jobs))
+            self._register(name, info.id)
+            return info
+        finally:
+            self._release([name])
+
+    def restore(self, run=None):
+        '''
+        Load the jobs in registry, of every run or only of run, so holds
+        on their names resolve as if this process had submitted them.
+        Names this process already knows are kept.  Returns the names
+        that were loaded.
+        '''
+        named, unnamed = self.registry.mappings(run)
+        with self._LOCK:
+            loaded = [n for n in named if n not in self._JOB_NAME_TO_ID]
+            self._JOB_NAME_TO_ID.update((n, named[n]) for n in loaded)
+            self._NO_NAME_JOBS.update(unnamed)
+        return loaded
+
+    def forget(self, names):
+        '''
+        Drop names from the submitted jobs so they can be submitted
+        again, holds on them then resolve to the new jobs.  Returns the
+        {name: jobid} that were dropped.
+        '''
+        with self._LOCK:
+            self._SKIPPED_NAMES.difference_update(names)
+            return {
+                n: self._JOB_NAME_TO_ID.pop(n)
+                for n in names if n in self._JOB_NAME_TO_ID
+            }
+
+    def array_size_limit(self):
+        '''
+        Most tasks one array may have, max_array_size if set otherwise
+        what the scheduler reports.  None if there is no known limit.
+        '''
+        if self.max_array_size is not None:
+            return self.max_array_size
+        return self._discover_max_array_size()
+
+    def indexed_array(self, jobs=(), name=None):
+        '''
+        An IndexedJobArray of jobs with its task files in scriptDir, named
+        like the script of a job called name would be.  jobs may be any
+        iterable, it is written out as it is consumed.
+        '''
+        if self.indexed_array_class is None:
+            raise NotImplementedError(
+                '{0} has no indexed job arrays'.format(type(self).__name__))
+        path = self._script_path(name, name or 'array')
+        return self.indexed_array_class(path, jobs)
+
+    def submit_parallel(self,
+                        jobs,
+                        hold=None,
+                        workDir=None,
+                        resource='',
+                        max_workers=None):
+        '''
+        Submit independent jobs concurrently from a thread pool of at most
+        max_workers threads, defaults to the max_workers attribute.
+
+        jobs takes the same form as in submit_many.  Since the jobs are
+        submitted concurrently, holds on names of other jobs in the same
+        call are not honored.  Returns one JobInfo per entry, if any
+        submission fails its exception is raised once all have finished.
+        '''
+        specs = self._job_specs(jobs, hold, workDir, resource)
+        self._reserve([s['name'] for s in specs if s['job']])
+
+        try:
+            with ThreadPoolExecutor(max_workers or self.max_workers) as pool:
+                futures = [
+                    pool.submit(self._submit_reserved, **s) if s['job'] else None
+                    for s in specs
+                ]
+        finally:
+            self._release([s['name'] for s in specs])
+
+        return [f.result() if f is not None else None for f in futures]
+
+    @property
+    def jobs(self):
+        with self._LOCK:
+            named = []
+            for jobid in self._JOB_NAME_TO_ID.values():
+                named.extend(jobid if isinstance(jobid, list) else [jobid])
+            return [j for j in named if j] + list(self._NO_NAME_JOBS)
+
+    def _job_specs(self, jobs, hold, workDir, resource):
+        defaults = dict(hold=hold, workDir=workDir, resource=resource, name=None)
+        specs = []
+        for job in jobs:
+            spec = dict(defaults)
+            if isinstance(job, dict):
+                spec.update(job)
+            else:
+                spec['job'] = job
+            specs.append(spec)
+        return specs
+
+    def _script_path(self, name, script_name):
+        '''
+        Named scripts are unique because names are reserved, anonymous
+        scripts get a counter so they never overwrite each other
+        '''
+        parts = [script_name, self.uid]
+        if name is None:
+            parts.insert(1, str(next(self._script_count)))
+        return self.scriptDir.joinpath(self.script_name_join.join(parts))
+
+    def _write_script(self, job, name, hold, workDir, resource,
+                      script_name=None, after=()):
+        '''
+        after are job ids to hold on besides those of the names in hold
+        '''
+        workDir = _abspath(workDir)
         logDir = self.logDir
         jid_list = self._map_name_to_jid(hold)
+        after = [a for a in after if a]
+        if after:
+            jid_list = (jid_list or []) + after
+
+        script_name = (script_name or name or 'job')
+        script_fp = self._script_path(name, script_name)
+
+        kwargs = locals()
+        kwargs.pop('self')
+        text = self._render_script(kwargs)
+
+        if self.stdin:
+            return self._keep_script(script_fp, text)
+        return self._save_script(script_fp, text)
 
-        script_name = (name or 'job')
-        #should do something here to ensure unique
-        script_fp = self.scriptDir.joinpath(
-            self.script_name_join.join([script_name, self.uid]))
+    @metrics.timed('render_script')
+    def _render_script(self, kwargs):
+        return self.template.render(shell=self.shell, **kwargs)
 
+    @metrics.timed('write_script')
+    def _save_script(self, script_fp, text):
+        if self.content_addressed:
+            return self.script_store().put(text)
         with open(script_fp, 'w') as fh:
-            kwargs = locals()
-            kwargs.pop('self')
-            fh.write(self.template.render(shell=self.shell, **kwargs))
+            fh.write(text)
+        return script_fp
 
-        job_info = self._submit_and_validate(script_fp, name)
-        return job_info
+    def _keep_script(self, script_fp, text):
+        if not self.archive:
+            return ScriptText(script_fp, text)
+        with self._LOCK:
+            if self._archive is None:
+                self._archive = ScriptArchive(self.scriptDir.joinpath(
+                    'scripts-{0}.gz'.format(self.uid)))
+        return self._archive.add(script_fp, text)
 
-    @property
-    def jobs(self):
-        return list(self._JOB_NAME_TO_ID.values()) + list(self._NO_NAME_JOBS)
+    def script_store(self):
+        return ScriptStore(self.scriptDir.joinpath('store'))
+
+    def close(self):
+        '''
+        Close the script archive, scripts in it can still be read
+        '''
+        if self._archive is not None:
+            self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def gc_scripts(self, jobids=None, min_age=3600):
+        '''
+        Remove stored scripts that no job in jobids uses.  The store is
+        shared by every driver using scriptDir, so without jobids the jobs
+        of all runs that registry does not know to be finished are kept,
+        and without a registry jobids is required.
+        '''
+        if jobids is None:
+            if self.registry is None:
+                raise ValueError('gc_scripts needs the jobids still in use '
+                                 'or a registry')
+            from drm.registry import SUBMITTED
+            jobids = [row[1] for row in self.registry.jobs(state=SUBMITTED)]
+        return self.script_store().gc(jobids, min_age)
 
     def _map_name_to_jid(self, name):
         '''
         If name is scalar, cast it has a list
         Remove any name entries that evaluate to false or
-        do not have an entry in _JOB_NAME_TO_ID
+        do not have an entry in _JOB_NAME_TO_ID, such as skipped
+        incremental jobs
         '''
-        if hasattr(name, '__iter__'):
-            job_ids = [self._JOB_NAME_TO_ID.get(n) for n in name if n]
-        else:
-            job_ids = [self._JOB_NAME_TO_ID.get(name)]
+        if isinstance(name, basestring) or not hasattr(name, '__iter__'):
+            name = [name]
+        job_ids = [self._JOB_NAME_TO_ID.get(n) for n in name if n]
 
-        final_job_ids = [x for x in job_ids if x is not None]
+        # a split array is registered with the ids of all its parts
+        final_job_ids = []
+        for x in job_ids:
+            if isinstance(x, list):
+                final_job_ids.extend(i for i in x if i is not None)
+            elif x is not None:
+                final_job_ids.append(x)
 
         return final_job_ids if final_job_ids else None
 
+    @metrics.timed('submit_cmd')
     def _submit(self, script_fp):
+        import sh
+        if isinstance(script_fp, ScriptText):
+            return sh.Command(self.submit_cmd)(_in=script_fp.text())
         return sh.Command(self.submit_cmd)(script_fp)
 
+    def pending_jobs(self):
+        '''
+        Number of this user's jobs waiting in the queue, None if unknown
+        '''
+        return None
+
+    def _submit_script(self, script_fp):
+        import sh
+        governor = self.governor
+        retries = governor.retry_delays() if governor else iter(())
+        while True:
+            if governor is not None:
+                governor.throttle(self)
+            try:
+                p = self._submit(script_fp)
+            except sh.CommandNotFound as err:
+                logger.warning(str(err))
+                return None
+            except sh.ErrorReturnCode as err:
+                delay = self._retry_delay(err, retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                return self._submitted(script_fp, p)
+
+    def _retry_delay(self, err, retries):
+        '''
+        Seconds to wait before submitting again after err, None if err
+        is not transient or there are no retries left
+        '''
+        output = b'\n'.join([err.stdout or b'', err.stderr or b''])
+        output = output.decode('utf-8', 'replace')
+        if self.transient_error is None or not re.search(
+                self.transient_error, output):
+            return None
+        delay = next(retries, None)
+        if delay is not None:
+            metrics.count('retries')
+            logger.warning('%s failed, retrying in %.1fs: %s',
+                           self.submit_cmd, delay, output.strip())
+        return delay
+
+    def _submitted(self, script_fp, p):
+        '''
+        Job id from the output of submit_cmd for script_fp
+        '''
+        # sh 2 returns the output itself, older versions a process
+        stdout = getattr(p, 'stdout', p)
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode()
+        jobid = self.get_jobid_from_submit(stdout)
+        metrics.count('submissions')
+        if self.content_addressed and not self.stdin:
+            self.script_store().ref(script_fp, [jobid])
+        return jobid
+
+    def _name_taken(self, name):
+        message = 'Name {0} already in _JOB_NAME_TO_ID with value {1}'.format(
+            name, self._JOB_NAME_TO_ID.get(name))
+        return RuntimeError(message)
+
+    def _check_names(self, names):
+        seen = set()
+        for name in names:
+            if (name in self._JOB_NAME_TO_ID or name in self._RESERVED_NAMES
+                    or name in self._SKIPPED_NAMES or name in seen):
+                raise self._name_taken(name)
+            seen.add(name)
+
+    def _reserve(self, names):
+        '''
+        Atomically claim names before anything is written or submitted
+        so concurrent submissions of the same name fail early
+        '''
+        names = [n for n in names if n is not None]
+        with self._LOCK:
+            self._check_names(names)
+            self._RESERVED_NAMES.update(names)
+
+    def _release(self, names):
+        with self._LOCK:
+            self._RESERVED_NAMES.difference_update(names)
+
+    def _register(self, name, jobid):
+        with self._LOCK:
+            self._RESERVED_NAMES.discard(name)
+            if name in self._JOB_NAME_TO_ID:
+                raise self._name_taken(name)
+
+            if name is not None:
+                self._JOB_NAME_TO_ID[name] = jobid
+            elif isinstance(jobid, list):
+                self._NO_NAME_JOBS.update(i for i in jobid if i)
+            elif jobid:
+                self._NO_NAME_JOBS.add(jobid)
+        if self.registry is not None:
+            self.registry.record(name, jobid, self.uid)
+
+    def _register_skipped(self, name):
+        with self._LOCK:
+            self._RESERVED_NAMES.discard(name)
+            self._check_names([name])
+            if name is not None:
+                self._SKIPPED_NAMES.add(name)
+
+    def _submit_reserved(self, job, name, hold, workDir, resource,
+                         inputs=(), outputs=()):
+        try:
+            if isinstance(job, JobArray):
+                info = self._submit_array(job, name, hold, workDir, resource)
+                self._register(name, info.id)
+                return info
+            job, fingerprint, skipped = self._incremental(
+                job, name, hold, workDir, resource, inputs, outputs)
+            if skipped is not None:
+                return skipped
+            script_fp = self._write_script(job, name, hold, workDir, resource)
+            info = self._submit_and_validate(script_fp, name)
+            self._remember(fingerprint, info)
+            return info
+        finally:
+            self._release([name])
+
+    def record_success(self, waiter):
+        '''
+        Mark the incremental jobs a Waiter saw succeed as done, for jobs
+        that could not write their own success marker
+        '''
+        for jobid in waiter.successful_jobs():
+            fingerprint = self._fingerprints.get(jobid)
+            if fingerprint is not None:
+                open(self._done_path(fingerprint, '.ok'), 'a').close()
+
+    def _done_path(self, fingerprint, suffix=''):
+        done = self.scriptDir.joinpath('done')
+        done.makedirs_p()
+        return done.joinpath(fingerprint + suffix)
+
+    def _fingerprint(self, job, name, workDir, resource, inputs, outputs):
+        '''
+        Hash of the script without the ids it holds on, which change
+        every run, and of the input and output paths
+        '''
+        text = self._render_script(dict(
+            job=job, name=name, hold=None, workDir=_abspath(workDir),
+            logDir=self.logDir, jid_list=None, script_name=name or 'job',
+            resource=resource))
+        paths = [os.path.abspath(str(p)) for p in inputs]
+        paths += ['>' + os.path.abspath(str(p)) for p in outputs]
+        return hashlib.sha256('\0'.join([text] + paths).encode(
+            'utf-8')).hexdigest()
+
+    def _incremental(self, job, name, hold, workDir, resource, inputs,
+                     outputs):
+        '''
+        (job to submit, fingerprint, SkippedJobInfo or None), job and
+        fingerprint are unchanged and None unless incremental is set
+        '''
+        if not self.incremental:
+            return job, None, None
+        fingerprint = self._fingerprint(job, name, workDir, resource, inputs,
+                                        outputs)
+        skipped = self._skip(fingerprint, name, hold, inputs, outputs)
+        if skipped is not None:
+            return job, fingerprint, skipped
+        return self._mark_success(job, fingerprint), fingerprint, None
+
+    def _skip(self, fingerprint, name, hold, inputs, outputs):
+        '''
+        SkippedJobInfo if the job does not need to run again, else None
+        '''
+        if self._map_name_to_jid(hold):
+            return None
+        try:
+            if not os.path.exists(self._done_path(fingerprint, '.ok')):
+                return None
+            oldest = min([os.path.getmtime(str(p)) for p in outputs] or
+                         [float('inf')])
+            newest = max([os.path.getmtime(str(p)) for p in inputs] or [0])
+            with open(self._done_path(fingerprint)) as fh:
+                jobid, script = fh.read().split('\t')
+            script = _abspath(script)
+            piped = self._done_path(fingerprint, '.sh')
+            if os.path.exists(piped):
+                with open(piped) as fh:
+                    script = ScriptText(script, fh.read())
+        except (OSError, IOError, ValueError):
+            return None
+        if newest > oldest:
+            return None
+        self._register_skipped(name)
+        return SkippedJobInfo(jobid, script, fingerprint)
+
+    def _mark_success(self, job, fingerprint):
+        '''
+        job run in a subshell followed by commands creating the success
+        marker of fingerprint if it exits 0.  An older marker is removed.
+        '''
+        ok = self._done_path(fingerprint, '.ok')
+        if os.path.exists(ok):
+            os.remove(ok)
+        return '(\n' + job + _SUCCESS_MARKER.format(quote(str(ok)))
+
+    def _remember(self, fingerprint, info):
+        '''
+        Keep the id and script of the job of fingerprint, the text too
+        if the script was piped and is not on disk
+        '''
+        if fingerprint is None or info.id is None:
+            return
+        self._fingerprints[info.id] = fingerprint
+        if isinstance(info.script, ScriptText):
+            self._write_done(fingerprint, '.sh', info.script.text())
+        self._write_done(fingerprint, '',
+                         '{0}\t{1}'.format(info.id, info.script))
+
+    def _write_done(self, fingerprint, suffix, text):
+        done_fp = self._done_path(fingerprint, suffix)
+        tmp = '{0}.{1}.tmp'.format(done_fp, self.uid)
+        with open(tmp, 'w') as fh:
+            fh.write(text)
+        os.replace(tmp, done_fp)
+
+    def _submit_array(self, array, name, hold, workDir, resource,
+                      script_name=None):
+        '''
+        Submit array in parts of at most array_size_limit() tasks, each
+        part holds on the one before if array.chain is set, else they split
+        the throttle between them
+        '''
+        limit = self.array_size_limit()
+        if limit and len(array) > limit:
+            parts = array.split(limit)
+        else:
+            parts = [array]
+        if len(parts) > 1 and array.throttle and not array.chain:
+            share, extra = divmod(array.throttle, len(parts))
+            for k, part in enumerate(parts):
+                part.throttle = max(1, share + (1 if k < extra else 0))
+
+        ids, scripts = [], []
+        for k, part in enumerate(parts):
+            part_name = script_name
+            if len(parts) > 1:
+                part_name = '{0}.{1}'.format(script_name or name or 'array', k)
+            after = ids[-1:] if array.chain else []
+            script_fp = self._write_script(part, name, hold, workDir,
+                                           resource, part_name, after)
+            ids.append(self._submit_script(script_fp))
+            scripts.append(script_fp)
+        return ArrayJobInfo(ids, scripts, len(parts[0]), len(array),
+                            self.array_task_id)
+
+    def _discover_max_array_size(self):
+        return None
+
     def _submit_and_validate(self, script_fp, name=None):
         '''
         Makes sure that within a single process we are not submitting
@@ -197,32 +1399,225 @@ class Submitter(object):
         the holdjid flag for the drm system. If there are more than one
         job with the same name this mapping is ambiguous.
         '''
-        try:
-            p = self._submit(script_fp)
-        except sh.CommandNotFound as err:
-            logger.warning(str(err))
-            jobid = None
-        else:
-            jobid = self.get_jobid_from_submit(p.stdout)
+        jobid = self._submit_script(script_fp)
+        self._register(name, jobid)
+        return JobInfo(jobid, script_fp)
 
-        if name in self._JOB_NAME_TO_ID:
-            message = 'Name {0} already in _JOB_NAME_TO_ID with value {1}'.format(
-                name, self._JOB_NAME_TO_ID.get(name))
-            raise RuntimeError(message)
 
-        if name is not None:
-            self._JOB_NAME_TO_ID[name] = jobid
-        elif jobid:
-            self._NO_NAME_JOBS.add(jobid)
+@attr.s
+class FixedInterval(object):
+    '''
+    Poll every interval seconds
+    '''
+    interval = attr.ib(default=60)
 
-        return JobInfo(jobid, script_fp)
+    def delays(self):
+        return itertools.repeat(self.interval)
+
+
+@attr.s
+class Backoff(object):
+    '''
+    Poll after initial seconds and multiply the delay by factor after
+    every poll up to cap seconds.  Each delay is randomized by +/- jitter
+    (a fraction) so many waiters do not query the scheduler in lockstep.
+    '''
+    initial = attr.ib(default=1)
+    factor = attr.ib(default=2)
+    cap = attr.ib(default=60)
+    jitter = attr.ib(default=0.1)
+
+    @classmethod
+    def for_resource(cls, resource, fraction=0.05, max_cap=600, **kwargs):
+        '''
+        Use the requested run time as an estimate, jobs asking for
+        more time are polled less often.  The cap is fraction of
+        resource.time bounded by max_cap, a cap given is used as max_cap.
+        '''
+        requested = getattr(resource, 'time', None)
+        if requested is None:
+            return cls(**kwargs)
+        max_cap = kwargs.pop('cap', max_cap)
+        floor = kwargs.get('initial', 1)
+        cap = min(max_cap, max(floor, requested.total_seconds() * fraction))
+        return cls(cap=cap, **kwargs)
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            jittered = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            yield min(self.cap, jittered)
+            delay = min(self.cap, delay * self.factor)
+
+
+@attr.s
+class Governor(object):
+    '''
+    Paces submissions of the Submitters it is set on.
+
+    At most rate submissions per second are made after an initial burst,
+    a submission failing with the submitter's transient_error is retried
+    up to retries times after the delays of policy, and with max_pending
+    set submitting blocks while the user already has that many jobs
+    pending, polling every pending_policy delay.  The pending count is
+    only asked for again once the headroom it gave is used up.
+    '''
+    rate = attr.ib(default=None)
+    burst = attr.ib(default=1)
+    retries = attr.ib(default=5)
+    policy = attr.ib(default=attr.Factory(
+        lambda: Backoff(initial=2, cap=120, jitter=0.5)))
+    max_pending = attr.ib(default=None)
+    pending_policy = attr.ib(default=attr.Factory(lambda: FixedInterval(30)))
+
+    _tokens = attr.ib(default=None, init=False, repr=False)
+    _stamp = attr.ib(default=None, init=False, repr=False)
+    _headroom = attr.ib(default=0, init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False,
+                    repr=False, cmp=False)
+    _pending_lock = attr.ib(default=attr.Factory(threading.Lock),
+                            init=False, repr=False, cmp=False)
+
+    @metrics.timed('throttle')
+    def throttle(self, submitter):
+        '''
+        Block until submitter may submit another job
+        '''
+        if self.max_pending is not None:
+            self._wait_for_headroom(submitter)
+        delay = self._take()
+        if delay > 0:
+            time.sleep(delay)
+
+    def retry_delays(self):
+        return itertools.islice(self.policy.delays(), self.retries)
+
+    def _take(self):
+        '''
+        Take a token from the bucket, returns how long to sleep until it
+        is really available.  Tokens are handed out in order so callers
+        that sleep are spaced 1 / rate apart.
+        '''
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            if self._stamp is None:
+                self._tokens = self.burst
+            else:
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def _wait_for_headroom(self, submitter):
+        with self._pending_lock:
+            delays = self.pending_policy.delays()
+            while self._headroom <= 0:
+                pending = submitter.pending_jobs()
+                if pending is None:
+                    return
+                self._headroom = self.max_pending - pending
+                if self._headroom <= 0:
+                    delay = next(delays)
+                    logger.info('%d jobs pending, waiting %.1fs to submit',
+                                pending, delay)
+                    time.sleep(delay)
+            self._headroom -= 1
 
 
 @attr.s
 class Waiter(object):
+    '''
+    Polls the drm until every job in jobid_lst has finished.
+
+    How long to sleep between polls is decided by policy, any object with
+    a delays() method returning an iterator of seconds.  By default polling
+    backs off from 1 second up to interval seconds.  timeout is a wall
+    clock deadline in seconds that includes the time spent querying.
+    '''
     jobid_lst = attr.ib(convert=_scalar_to_iter)
     interval = attr.ib(default=60)
     timeout = attr.ib(default=None)
+    policy = attr.ib(default=None)
+
+    # _info maps a job id to whatever the drm last reported for it, once a
+    # job reaches a final state it moves from _unfinished to one of the
+    # ordered _successful/_unsuccessful dicts and is never queried again
+    _info = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _unfinished = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    _successful = attr.ib(
+        default=attr.Factory(OrderedDict), init=False, repr=False)
+    _unsuccessful = attr.ib(
+        default=attr.Factory(OrderedDict), init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._unfinished.update(self.jobid_lst)
 
     def wait(self):
+        delays = self.delays()
+        deadline = self._deadline()
+        while (True):
+            self.query()
+            delay = self._next_delay(delays, deadline)
+            if delay is None:
+                return self
+            time.sleep(delay)
+
+    def delays(self):
+        policy = self.policy
+        if policy is None:
+            policy = Backoff(initial=min(1, self.interval), cap=self.interval)
+        return policy.delays()
+
+    def query(self):
         raise NotImplementedError()
+
+    def successful_jobs(self):
+        return list(self._successful)
+
+    def unsuccessful_jobs(self):
+        return list(self._unsuccessful)
+
+    def unfinished_jobs(self):
+        return list(self._unfinished)
+
+    def finished(self):
+        '''
+        True once every job in jobid_lst has reached a final state
+        '''
+        return not self._unfinished
+
+    def _update(self, jobid, info, successful=None):
+        '''
+        Record the latest info for jobid, successful is None while the
+        job has not reached a final state
+        '''
+        self._info[jobid] = info
+        if successful is None:
+            return
+        self._unfinished.discard(jobid)
+        if successful:
+            self._successful[jobid] = info
+        else:
+            self._unsuccessful[jobid] = info
+
+    def _deadline(self):
+        if self.timeout is None:
+            return None
+        return time.monotonic() + self.timeout
+
+    def _next_delay(self, delays, deadline):
+        '''
+        Seconds to sleep before the next query, None when waiting is over
+        '''
+        if self.finished():
+            return None
+        delay = next(delays)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            delay = min(delay, remaining)
+        return delay
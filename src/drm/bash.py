@@ -0,0 +1,482 @@
+from __future__ import division
+import collections
+import itertools
+import logging
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+
+import attr
+
+import drm.base as base
+
+logger = logging.getLogger(__name__)
+
+
+@base.none_guard_filters
+def make_environment(template_dict):
+    def format_seconds(time):
+        return '{0:.0f}'.format(time.total_seconds())
+
+    def format_log(logDir, script_name, name, job):
+        '''
+        %j is replaced by the job id and %a by the array task id
+        '''
+        log = os.path.join(logDir, script_name)
+        if name is None:
+            log += '.%j'
+        if isinstance(job, JobArray):
+            log += '.%a'
+        return log
+
+    env = base.make_jinja_env(template_dict)
+    env.filters['format_jid_list'] = lambda x: ':'.join(x)
+    env.filters['format_seconds'] = format_seconds
+    env.filters['format_log'] = format_log
+    env.filters['format_throttle'] = base.array_throttle
+
+    env.tests['array'] = lambda x: isinstance(x, JobArray)
+    return env
+
+
+template_dict = {}
+
+template_dict['resource'] = '''\
+#DRM -c {{ workers }}
+#DRM --mem={{ memInGB }}
+#DRM -t {{ time|format_seconds }}
+'''
+
+template_dict['array'] = '''\
+{% for job in jobs %}
+if [ $DRM_ARRAY_TASK_ID == {{ loop.index - 1 }} ]; then
+  {{ job }}
+fi
+{% endfor %}'''
+
+template_dict['job'] = '''#!{{ shell }}
+{% if name is not none %}
+#DRM -J {{ name }}
+{% endif %}
+{% if job is array %}
+#DRM --array={{ job|length }}{{ job|format_throttle }}
+{% endif %}
+#DRM -o {{ logDir|format_log(script_name, name, job) }}.stdout
+#DRM -e {{ logDir|format_log(script_name, name, job) }}.stderr
+#DRM -D {{ workDir }}
+{% if jid_list is not none %}
+#DRM -d afterok:{{ jid_list|format_jid_list }}
+{% endif %}
+
+{{ resource }}
+
+{{ job }}
+'''
+
+get_environment = base.lazy_environment(make_environment, template_dict)
+
+
+_ENDS_IN_NONE = re.compile(r'None\s*$')
+
+
+def remove_lines_ending_in_none(_str):
+    lines = _str.split(os.linesep)
+    return os.linesep.join(e for e in lines if not _ENDS_IN_NONE.search(e))
+
+
+class Constraint(base.Constraint):
+    '''
+    Constraints have no meaning on a single machine
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        return ''
+
+
+class Resource(base.Resource):
+    __slots__ = ()
+
+    _template = base.LazyTemplate(get_environment, 'resource')
+
+    @base.cached_str
+    def __str__(self):
+        return remove_lines_ending_in_none(
+            self._template.render(**attr.asdict(self, recurse=False)))
+
+
+class MpiResource(base.MpiResource):
+    __slots__ = ()
+
+    _template = base.LazyTemplate(get_environment, 'resource')
+
+    @base.cached_str
+    def __str__(self):
+        return remove_lines_ending_in_none(
+            self._template.render(**attr.asdict(self, recurse=False)))
+
+
+class JobArray(base.JobArray):
+    _template = base.LazyTemplate(get_environment, 'array')
+
+    def add_job(self, job):
+        self.jobs.append(job)
+
+    def __str__(self):
+        return self._template.render(jobs=self.jobs)
+
+
+class IndexedJobArray(base.IndexedJobArray, JobArray):
+    task_id = '$DRM_ARRAY_TASK_ID'
+
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+TIMEOUT = 'TIMEOUT'
+
+FINAL_STATES = (COMPLETED, FAILED, CANCELLED, TIMEOUT)
+
+
+def parse_directives(script):
+    '''
+    Options from the #DRM lines of a script, its text or an open file, as
+    a dict, the interpreter from the #! line is stored under '#!'.  Only
+    the header is read: parsing stops at the first line that is neither
+    blank nor a comment.
+    '''
+    options = {}
+    lines = script.splitlines() if hasattr(script, 'splitlines') else script
+    for i, line in enumerate(lines):
+        line = line.rstrip('\n')
+        if i == 0 and line.startswith('#!'):
+            options['#!'] = line[2:].strip()
+            continue
+        if line.strip() and not line.startswith('#'):
+            break
+        if not line.startswith('#DRM '):
+            continue
+        option = line[len('#DRM '):].strip()
+        if option.startswith('--'):
+            key, _, value = option.partition('=')
+        else:
+            key, _, value = option.partition(' ')
+        options[key] = value.strip()
+    return options
+
+
+def _machine_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _machine_memory():
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return pages * page_size / 1e9
+
+
+@attr.s
+class LocalJob(object):
+    id = attr.ib()
+    command = attr.ib()
+    stdout = attr.ib()
+    stderr = attr.ib()
+    workDir = attr.ib()
+    workers = attr.ib(default=1)
+    memInGB = attr.ib(default=0)
+    timeout = attr.ib(default=None)
+    after = attr.ib(default=attr.Factory(list))
+    env = attr.ib(default=attr.Factory(dict))
+    array = attr.ib(default=None)
+    state = attr.ib(default=PENDING)
+    returncode = attr.ib(default=None)
+
+
+class LocalExecutor(object):
+    '''
+    Runs job scripts as local processes.
+
+    Jobs are started as soon as every job they hold on has completed and
+    the cpus (workers) and memory (memInGB) they ask for are free, so the
+    machine is neither oversubscribed nor idle.  Requests larger than the
+    machine are clamped so the job can still run on its own.  Jobs are
+    considered in submission order but a job that fits may start ahead of
+    one that does not.  A job whose dependency fails is cancelled.  An
+    array with a throttle runs at most that many tasks at a time.
+    '''
+
+    def __init__(self, cpus=None, memInGB=None):
+        self.cpus = cpus or _machine_cpus()
+        self.memInGB = memInGB if memInGB is not None else _machine_memory()
+
+        self._free_cpus = self.cpus
+        self._free_mem = self.memInGB
+        self._jobs = {}
+        self._arrays = {}
+        self._throttles = {}
+        self._array_running = collections.Counter()
+        self._pending = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def submit(self, script_fp, text=None):
+        '''
+        Queue the script at script_fp, or the script text if given, and
+        return its job id
+        '''
+        if text is None:
+            with open(script_fp) as fh:
+                options = parse_directives(fh)
+            args = [script_fp]
+        else:
+            options = parse_directives(text)
+            args = ['-c', text]
+
+        with self._cond:
+            jobid = str(next(self._ids))
+            if '--array' in options:
+                tasks, _, throttle = options['--array'].partition('%')
+                ids = ['{0}_{1}'.format(jobid, i) for i in range(int(tasks))]
+                self._arrays[jobid] = ids
+                if throttle:
+                    self._throttles[jobid] = int(throttle)
+                for i, task_id in enumerate(ids):
+                    self._add(self._job(task_id, args, options, jobid, i))
+            else:
+                self._add(self._job(jobid, args, options, jobid))
+            self._schedule()
+        return jobid
+
+    def status(self, jobid):
+        '''
+        State of a job, for an array id the state of all its tasks
+        '''
+        with self._cond:
+            return self._status(jobid)
+
+    def pending(self):
+        '''
+        Number of jobs and array tasks waiting to start
+        '''
+        with self._cond:
+            return len(self._pending)
+
+    def returncode(self, jobid):
+        with self._cond:
+            job = self._jobs.get(jobid)
+            return None if job is None else job.returncode
+
+    def wait(self, timeout=None):
+        '''
+        Block until every submitted job has reached a final state
+        '''
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: all(job.state in FINAL_STATES
+                            for job in self._jobs.values()), timeout)
+
+    def _job(self, jobid, args, options, parent, task=None):
+        def expand(path):
+            path = path.replace('%j', parent)
+            return path if task is None else path.replace('%a', str(task))
+
+        env = {'DRM_JOB_ID': parent}
+        array = None
+        if task is not None:
+            env['DRM_ARRAY_TASK_ID'] = str(task)
+            array = parent
+
+        timeout = options.get('-t')
+        after = options.get('-d', '')
+        if after.startswith('afterok:'):
+            after = [a for a in after[len('afterok:'):].split(':') if a]
+        else:
+            after = []
+
+        shell = shlex.split(options.get('#!') or base.Submitter.shell)
+        return LocalJob(
+            id=jobid,
+            command=shell + args,
+            stdout=expand(options.get('-o', os.devnull)),
+            stderr=expand(options.get('-e', os.devnull)),
+            workDir=options.get('-D') or os.getcwd(),
+            workers=min(self.cpus, max(1, int(options.get('-c', 1)))),
+            memInGB=float(options.get('--mem', 0)),
+            timeout=float(timeout) if timeout else None,
+            after=after,
+            env=env,
+            array=array)
+
+    def _add(self, job):
+        if self.memInGB is not None:
+            job.memInGB = min(job.memInGB, self.memInGB)
+        self._jobs[job.id] = job
+        self._pending[job.id] = job
+
+    def _status(self, jobid):
+        if jobid in self._arrays:
+            states = [self._jobs[t].state for t in self._arrays[jobid]]
+            if all(s == COMPLETED for s in states):
+                return COMPLETED
+            elif all(s in FINAL_STATES for s in states):
+                return FAILED
+            elif RUNNING in states:
+                return RUNNING
+            else:
+                return PENDING
+        job = self._jobs.get(jobid)
+        return None if job is None else job.state
+
+    def _schedule(self):
+        '''
+        Start every pending job that can run, called with the lock held
+        '''
+        for job in list(self._pending.values()):
+            states = [self._status(a) for a in job.after]
+            if any(s in FINAL_STATES and s != COMPLETED for s in states):
+                del self._pending[job.id]
+                job.state = CANCELLED
+                self._cond.notify_all()
+                continue
+            if any(s is not None and s != COMPLETED for s in states):
+                continue
+            if job.workers > self._free_cpus:
+                continue
+            if self._free_mem is not None and job.memInGB > self._free_mem:
+                continue
+            throttle = self._throttles.get(job.array)
+            if throttle and self._array_running[job.array] >= throttle:
+                continue
+
+            del self._pending[job.id]
+            self._start(job)
+
+    def _start(self, job):
+        self._free_cpus -= job.workers
+        if self._free_mem is not None:
+            self._free_mem -= job.memInGB
+        job.state = RUNNING
+        if job.array is not None:
+            self._array_running[job.array] += 1
+
+        env = dict(os.environ, **job.env)
+        try:
+            with open(job.stdout, 'w') as out, open(job.stderr, 'w') as err:
+                proc = subprocess.Popen(
+                    job.command,
+                    cwd=job.workDir,
+                    stdout=out,
+                    stderr=err,
+                    env=env,
+                    start_new_session=True)
+        except (OSError, IOError) as err:
+            logger.warning('Could not start job %s: %s', job.id, err)
+            self._finish(job, FAILED, None)
+            return
+
+        thread = threading.Thread(target=self._watch, args=(job, proc))
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, job, proc):
+        try:
+            returncode = proc.wait(timeout=job.timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            returncode = proc.wait()
+            state = TIMEOUT
+        else:
+            state = COMPLETED if returncode == 0 else FAILED
+
+        with self._cond:
+            self._finish(job, state, returncode)
+            self._schedule()
+
+    def _finish(self, job, state, returncode):
+        if job.state == RUNNING and job.array is not None:
+            self._array_running[job.array] -= 1
+        job.state = state
+        job.returncode = returncode
+        self._free_cpus += job.workers
+        if self._free_mem is not None:
+            self._free_mem += job.memInGB
+        self._cond.notify_all()
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor():
+    '''
+    The LocalExecutor shared by every Submitter and Waiter in this process
+    '''
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = LocalExecutor()
+        return _EXECUTOR
+
+
+Submission = collections.namedtuple('Submission', ['stdout'])
+
+
+class Submitter(base.Submitter):
+    '''
+    Runs jobs on this machine with the process wide LocalExecutor.
+    Output goes to <logDir>/<name>.stdout and <logDir>/<name>.stderr.
+    '''
+    template = base.LazyTemplate(get_environment, 'job')
+    submit_cmd = 'bash'
+    array_class = JobArray
+    indexed_array_class = IndexedJobArray
+
+    def get_jobid_from_submit(self, stdout):
+        return stdout.strip()
+
+    def pending_jobs(self):
+        return get_executor().pending()
+
+    @base.metrics.timed('submit_cmd')
+    def _submit(self, script_fp):
+        if isinstance(script_fp, base.ScriptText):
+            return Submission(
+                get_executor().submit(script_fp, script_fp.text()))
+        return Submission(get_executor().submit(script_fp))
+
+
+@attr.s
+class Waiter(base.Waiter):
+    '''
+    Class for waiting on jobs run by the LocalExecutor of this process
+
+    Asking the executor is cheap so by default polling starts at 10ms
+    and backs off to at most a second.
+    '''
+
+    def delays(self):
+        if self.policy is None:
+            return base.Backoff(
+                initial=0.01, cap=min(1, self.interval)).delays()
+        return super(Waiter, self).delays()
+
+    def query(self):
+        executor = get_executor()
+        for jobid in list(self._unfinished):
+            state = executor.status(jobid)
+            if state is None or state in FINAL_STATES:
+                self._update(jobid, (state, executor.returncode(jobid)),
+                             state == COMPLETED)
+            else:
+                self._update(jobid, (state, None))
+        return self
@@ -0,0 +1,189 @@
+'''
+Workflows declared up front as a graph of named jobs.
+
+    >>> dag = DAG()
+    >>> dag.add_job('align', 'bwa mem ...', resource=resource)
+    >>> dag.add_job('call', 'gatk ...', after=['align'])
+    >>> infos = dag.submit(submitter)
+
+Jobs are submitted in topological waves, each wave through
+Submitter.submit_many so jobs that share a resource, workDir and holds
+become one array job.  Within a wave jobs on the longest remaining path
+are submitted first.  Dependencies on names that are not in the graph are
+passed through as holds on jobs submitted earlier.
+'''
+import collections
+from datetime import timedelta
+
+import attr
+
+
+@attr.s
+class Node(object):
+    name = attr.ib()
+    job = attr.ib()
+    resource = attr.ib(default='')
+    workDir = attr.ib(default=None)
+    after = attr.ib(default=attr.Factory(list))
+
+    @property
+    def weight(self):
+        '''
+        Seconds of requested run time, 1 if the resource has no time
+        '''
+        time = getattr(self.resource, 'time', None)
+        if isinstance(time, timedelta):
+            return max(1, time.total_seconds())
+        return 1
+
+
+class DAG(object):
+    def __init__(self):
+        self._nodes = collections.OrderedDict()
+        self._children = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def add_job(self, name, job, after=None, resource='', workDir=None):
+        '''
+        Declare job under name, it will hold on every name in after
+        '''
+        if name in self._nodes:
+            raise RuntimeError('Name {0} already in DAG'.format(name))
+        after = [a for a in _as_list(after) if a]
+        self._nodes[name] = Node(name, job, resource, workDir, after)
+        for parent in after:
+            self._children[parent].append(name)
+        return self._nodes[name]
+
+    def add_edge(self, parent, child):
+        '''
+        child holds on parent
+        '''
+        self._nodes[child].after.append(parent)
+        self._children[parent].append(child)
+
+    def parents(self, name):
+        return [p for p in self._nodes[name].after if p in self._nodes]
+
+    def children(self, name):
+        return list(self._children.get(name, []))
+
+    def validate(self):
+        '''
+        Topological order of the names, raises ValueError on a cycle
+        '''
+        indegree = dict((name, len(self.parents(name))) for name in self._nodes)
+        ready = collections.deque(n for n, d in indegree.items() if d == 0)
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for child in self._children.get(name, []):
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    ready.append(child)
+
+        if len(order) != len(self._nodes):
+            cycle = sorted(n for n, d in indegree.items() if d > 0)
+            raise ValueError('DAG has a cycle through {0}'.format(
+                ', '.join(cycle[:10])))
+        return order
+
+    def waves(self):
+        '''
+        Lists of names that only depend on names in earlier lists, each
+        list is ordered by critical path length, longest first
+        '''
+        order = self.validate()
+        level = {}
+        for name in order:
+            level[name] = 1 + max(
+                [level[p] for p in self.parents(name)] or [-1])
+
+        remaining = self._critical_path(order)
+        waves = [[] for _ in range(max(level.values()) + 1 if level else 0)]
+        for name in order:
+            waves[level[name]].append(name)
+        for wave in waves:
+            wave.sort(key=lambda n: -remaining[n])
+        return waves
+
+    def critical_path(self):
+        '''
+        Map of name to the summed weight of the heaviest path from that
+        job to the end of the workflow, itself included
+        '''
+        return self._critical_path(self.validate())
+
+    def subgraph(self, roots):
+        '''
+        A DAG of roots and every job downstream of them, used to re-run
+        part of a workflow.  Edges to jobs left out become holds on names
+        that were submitted before.
+        '''
+        keep = set()
+        stack = [r for r in _as_list(roots)]
+        while stack:
+            name = stack.pop()
+            if name in keep:
+                continue
+            if name not in self._nodes:
+                raise KeyError(name)
+            keep.add(name)
+            stack.extend(self._children.get(name, []))
+
+        sub = DAG()
+        for name, node in self._nodes.items():
+            if name in keep:
+                sub.add_job(name, node.job, list(node.after), node.resource,
+                            node.workDir)
+        return sub
+
+    def submit(self, submitter, rerun=None):
+        '''
+        Submit every job, or only rerun and its descendants, wave by wave.
+        The names of rerun jobs are forgotten by submitter first.  Returns
+        a dict of name to JobInfo.
+        '''
+        dag = self
+        if rerun is not None:
+            dag = self.subgraph(rerun)
+            submitter.forget(list(dag))
+        infos = {}
+        for wave in dag.waves():
+            specs = []
+            for name in wave:
+                node = dag._nodes[name]
+                specs.append({
+                    'job': node.job,
+                    'name': name,
+                    'hold': node.after or None,
+                    'workDir': node.workDir,
+                    'resource': node.resource,
+                })
+            for name, info in zip(wave, submitter.submit_many(specs)):
+                infos[name] = info
+        return infos
+
+    def _critical_path(self, order):
+        remaining = {}
+        for name in reversed(order):
+            below = [remaining[c] for c in self._children.get(name, [])]
+            remaining[name] = self._nodes[name].weight + max(below or [0])
+        return remaining
+
+
+def _as_list(arg):
+    if arg is None:
+        return []
+    if isinstance(arg, (list, tuple, set, frozenset)):
+        return list(arg)
+    return [arg]
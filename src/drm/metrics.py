@@ -0,0 +1,219 @@
+'''
+Client side timings and counters of submitting, rendering and polling.
+
+Instrumented code reports events to the callables in HOOKS, each is
+called as hook(kind, name, value) where kind is 'latency' (seconds),
+'count' or 'size'.  With no hooks installed, which is the default,
+instrumented calls only check that HOOKS is empty.
+
+enable() installs a Registry that keeps a histogram per latency and size
+and a total per count, exportable as Prometheus text or JSON.  Setting
+DRM_METRICS to a file name enables it on import and writes it there at
+exit, as JSON if the name ends in .json.
+
+    >>> registry = metrics.enable()
+    >>> submitter.submit_job('ls')
+    >>> registry.write_textfile('/var/lib/node_exporter/drm.prom')
+'''
+import atexit
+import functools
+import inspect
+import os
+import threading
+import time
+
+HOOKS = []
+
+# upper bounds of the histogram buckets, an implicit +Inf follows
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1,
+                   5, 10, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def emit(kind, name, value):
+    for hook in HOOKS:
+        hook(kind, name, value)
+
+
+def count(name, value=1):
+    if HOOKS:
+        emit('count', name, value)
+
+
+def observe(name, value):
+    if HOOKS:
+        emit('size', name, value)
+
+
+def timed(name):
+    '''
+    Decorator reporting the latency of every call as name, works on
+    coroutine functions too
+    '''
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not HOOKS:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    emit('latency', name, time.perf_counter() - start)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not HOOKS:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                emit('latency', name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''
+        (upper bound, count of values <= bound) per bucket, Prometheus style
+        '''
+        total = 0
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        for bound, n in zip(bounds, self.counts):
+            total += n
+            yield bound, total
+
+
+class Registry(object):
+    '''
+    A hook keeping every event it is called with, thread safe
+    '''
+
+    def __init__(self, prefix='drm'):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, kind, name, value):
+        with self._lock:
+            if kind == 'count':
+                self.counters[name] = self.counters.get(name, 0) + value
+                return
+            key = (kind, name)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                buckets = LATENCY_BUCKETS if kind == 'latency' else SIZE_BUCKETS
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.add(value)
+
+    def histogram(self, kind, name):
+        return self.histograms.get((kind, name))
+
+    def as_dict(self):
+        with self._lock:
+            histograms = {}
+            for (kind, name), h in sorted(self.histograms.items()):
+                histograms[self._metric(kind, name)] = {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'buckets': dict(h.cumulative()),
+                }
+            return {
+                'counters': {
+                    self._metric('count', name): value
+                    for name, value in sorted(self.counters.items())
+                },
+                'histograms': histograms,
+            }
+
+    def prometheus(self):
+        '''
+        Everything in the Prometheus text exposition format
+        '''
+        data = self.as_dict()
+        lines = []
+        for metric, value in sorted(data['counters'].items()):
+            lines += ['# TYPE {0} counter'.format(metric),
+                      '{0} {1}'.format(metric, value)]
+        for metric, h in sorted(data['histograms'].items()):
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for bound, n in h['buckets'].items():
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                    metric, bound, n))
+            lines += ['{0}_sum {1!r}'.format(metric, h['sum']),
+                      '{0}_count {1}'.format(metric, h['count'])]
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Prometheus text written atomically, for the node exporter textfile
+        collector
+        '''
+        _write_atomic(path, self.prometheus())
+
+    def write_json(self, path):
+        import json
+        _write_atomic(path, json.dumps(self.as_dict(), indent=2, sort_keys=True))
+
+    def _metric(self, kind, name):
+        suffix = {'latency': '_seconds', 'count': '_total'}.get(kind, '')
+        return '{0}_{1}{2}'.format(self.prefix, name, suffix)
+
+
+def _write_atomic(path, text):
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(text)
+    os.replace(tmp, path)
+
+
+def enable(registry=None):
+    '''
+    Install registry, a new Registry by default, as a hook and return it
+    '''
+    if registry is None:
+        registry = Registry()
+    HOOKS.append(registry)
+    return registry
+
+
+def disable():
+    '''
+    Remove every hook
+    '''
+    del HOOKS[:]
+
+
+def _export_at_exit(registry, path):
+    if path.endswith('.json'):
+        registry.write_json(path)
+    else:
+        registry.write_textfile(path)
+
+
+if os.environ.get('DRM_METRICS'):
+    atexit.register(_export_at_exit, enable(), os.environ['DRM_METRICS'])
@@ -1,9 +1,13 @@
 from __future__ import division
 from past.utils import old_div
+import getpass
 import re
 import math
+from xml.etree import ElementTree
+
 import attr
 
+import drm.aio as aio
 import drm.base as base
 
 
@@ -41,6 +45,7 @@ def make_environment(template_dict):
     env.filters['format_timedelta'] = format_timedelta
     env.filters['format_concurrent'] = format_concurrent
     env.filters['format_name'] = format_name
+    env.filters['format_throttle'] = base.array_throttle
 
     env.tests['array'] = lambda x: isinstance(x, JobArray)
     return env
@@ -60,7 +65,7 @@ vmem={{ memInGB| format_memory }},walltime={{ time|format_timedelta }}
 
 template_dict['array'] = '''
 {% for job in jobs %}
-if [ ${PBS_ARRAYID} == {{ loop.index - 1 }} ]
+if [ ${PBS_ARRAYID} == {{ loop.index - 1 }} ]; then
   {{ job }}
 fi
 {% endfor %}
@@ -72,7 +77,7 @@ template_dict['job'] = '''#!{{ shell }}
 #PBS -e {{ logDir }}
 #PBS -d {{ workDir }}
 {% if job is array %} 
-#PBS -t 0-{{ job|length - 1 }}
+#PBS -t 0-{{ job|length - 1 }}{{ job|format_throttle }}
 {% endif %}
 {% if name is not none %}
 #PBS -N {{ name }}
@@ -87,7 +92,7 @@ template_dict['job'] = '''#!{{ shell }}
 {{ job }}
 '''
 
-_ENV = make_environment(template_dict)
+get_environment = base.lazy_environment(make_environment, template_dict)
 
 
 def remove_empty_resources(_str):
@@ -101,13 +106,18 @@ def remove_empty_resources(_str):
 
 
 class Constraint(base.Constraint):
+    __slots__ = ()
+
     def __str__(self):
         return '{}'.format(self.features)
 
 
 class Resource(base.Resource):
-    _template = _ENV.get_template('resource')
+    __slots__ = ()
+
+    _template = base.LazyTemplate(get_environment, 'resource')
 
+    @base.cached_str
     def __str__(self):
         return remove_empty_resources(
             self._template.render(
@@ -116,8 +126,11 @@ class Resource(base.Resource):
 
 
 class MpiResource(base.MpiResource):
-    _template = _ENV.get_template('mpi_resource')
+    __slots__ = ()
 
+    _template = base.LazyTemplate(get_environment, 'mpi_resource')
+
+    @base.cached_str
     def __str__(self):
         return remove_empty_resources(
             self._template.render(
@@ -126,7 +139,7 @@ class MpiResource(base.MpiResource):
 
 
 class JobArray(base.JobArray):
-    _template = _ENV.get_template('array')
+    _template = base.LazyTemplate(get_environment, 'array')
 
     def add_job(self, job):
         self.jobs.append(job)
@@ -135,9 +148,165 @@ class JobArray(base.JobArray):
         return self._template.render(jobs=self.jobs)
 
 
+class IndexedJobArray(base.IndexedJobArray, JobArray):
+    task_id = '${PBS_ARRAYID}'
+
+
+class JobTemplate(object):
+    '''
+    Renders exactly what template_dict['job'] does with string joins,
+    used instead of Jinja unless DRM_FAST_RENDER=0
+    '''
+
+    def render(self, shell, job, name, workDir, logDir, jid_list, resource,
+               **kwargs):
+        logDir = str(logDir)
+        parts = ['#!', str(shell), '\n#PBS -V\n#PBS -o ', logDir,
+                 '\n#PBS -e ', logDir, '\n#PBS -d ', str(workDir), '\n']
+        if isinstance(job, JobArray):
+            parts += [' \n#PBS -t 0-', str(len(job) - 1),
+                      base.array_throttle(job), '\n']
+        if name is not None:
+            parts += ['#PBS -N ', str(name), '\n']
+        parts.append('\n')
+        if jid_list is not None:
+            parts += ['#PBS -W depend=afterok:', ':'.join(jid_list), '\n']
+        parts += ['\n', str(resource), '\n\n', str(job), '\n']
+        return ''.join(parts)
+
+
 class Submitter(base.Submitter):
-    template = _ENV.get_template('job')
+    template = (JobTemplate() if base.FAST_RENDER else
+                base.LazyTemplate(get_environment, 'job'))
     submit_cmd = 'qsub'
+    array_class = JobArray
+    indexed_array_class = IndexedJobArray
+    transient_error = re.compile(
+        r'Maximum number of jobs|would exceed|cannot connect to server|'
+        r'End of File|Resource temporarily unavailable|try again',
+        re.IGNORECASE)
 
     def get_jobid_from_submit(self, stdout):
         return stdout.strip()
+
+    def pending_jobs(self):
+        # the state column comes before the elapsed time, -t lists tasks
+        return base.count_pending(
+            ('qstat', '-t', '-u', getpass.getuser()),
+            lambda line: line.split()[-2:-1] in (['Q'], ['H'], ['W']))
+
+    def _discover_max_array_size(self):
+        return base.scheduler_setting(('qmgr', '-c', 'print server'),
+                                      r'max_job_array_size\s*=\s*(\d+)')
+
+    def array_task_id(self, array_id, index):
+        '''
+        Torque array ids look like 1234[].server, a task is 1234[5].server
+        '''
+        if '[]' in array_id:
+            return array_id.replace('[]', '[{0}]'.format(index), 1)
+        else:
+            return '{0}[{1}]'.format(array_id, index)
+
+
+@attr.s
+class Waiter(base.Waiter):
+    '''
+    Class for waiting on jobids using qstat
+
+    Every poll is one qstat -x -t call for all jobs, array sub-jobs included.
+    The XML is parsed incrementally as it is read so memory use does not
+    grow with the size of the queue.
+
+    Job ids are matched without the server suffix.  Waiting on an array id
+    (1234[].server) waits for every sub-job qstat lists for that array, it
+    fails if any of them fail.  Completed jobs are only listed for as long
+    as the server keeps them (keep_completed), a job qstat does not list
+    is unsuccessful with the state UNKNOWN.
+    '''
+    _final_states = ['C', 'F']
+    _args = ['qstat', '-x', '-t']
+    _cmd = base.LazyCommand(_args)
+
+    _bufsize = 2**16
+
+    def query(self):
+        if not self._unfinished:
+            return self
+        chunks = self._cmd(_iter=True, _out_bufsize=self._bufsize)
+        self._apply(self._latest(chunks))
+        return self
+
+    def _query_args(self):
+        return [self._args] if self._unfinished else []
+
+    def _parse(self, raw_data):
+        if raw_data:
+            self._apply(self._latest([raw_data]))
+        return self
+
+    def _latest(self, chunks):
+        '''
+        Latest (job_state, exit_status) of every unfinished job, (UNKNOWN,
+        None) for jobs qstat no longer lists
+        '''
+        wanted = dict((self._short(j), j) for j in self._unfinished)
+        latest = {}
+        arrays = {}
+        for job_id, state, exit_status in self._jobs(chunks):
+            short = self._short(job_id)
+            if short in wanted:
+                latest[wanted[short]] = (state, exit_status)
+            parent = re.sub(r'\[\d+\]', '[]', short)
+            if parent != short and parent in wanted:
+                arrays.setdefault(wanted[parent], []).append(
+                    (state, exit_status))
+
+        for jobid, tasks in arrays.items():
+            unfinished = [t for t in tasks if t[0] not in self._final_states]
+            failed = [t for t in tasks if t[1] != '0']
+            latest[jobid] = (unfinished or failed or tasks)[0]
+        for jobid in wanted.values():
+            latest.setdefault(jobid, ('UNKNOWN', None))
+        return latest
+
+    def _jobs(self, chunks):
+        '''
+        (Job_Id, job_state, exit_status) of each Job element, elements are
+        discarded as soon as they are read
+        '''
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        root = None
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if root is None:
+                    root = elem
+                elif event == 'end' and elem.tag == 'Job':
+                    yield (elem.findtext('Job_Id'), elem.findtext('job_state'),
+                           elem.findtext('exit_status'))
+                    root.clear()
+        parser.close()
+
+    def _apply(self, latest):
+        for jobid, info in latest.items():
+            self._update(jobid, info, self._is_successful(*info))
+
+    def _is_successful(self, state, exit_status):
+        if state == 'UNKNOWN':
+            return False
+        if state not in self._final_states:
+            return None
+        return exit_status == '0'
+
+    def _short(self, jobid):
+        return jobid.split('.', 1)[0]
+
+
+class AsyncSubmitter(aio.AsyncSubmitter, Submitter):
+    pass
+
+
+@attr.s
+class AsyncWaiter(aio.AsyncWaiter, Waiter):
+    pass
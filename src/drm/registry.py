@@ -0,0 +1,173 @@
+'''
+Job names and ids kept in SQLite so a driver that restarts can resolve
+holds on jobs submitted by an earlier process.
+
+A Submitter with a registry records every job it submits, with the uid
+of the Submitter as its run, and Submitter.restore() loads the mappings
+back.  Writes are buffered and committed in one transaction per batch,
+at most max_delay seconds after a job was submitted.
+'''
+import atexit
+import functools
+import sqlite3
+import threading
+import time
+
+SUBMITTED = 'SUBMITTED'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT,
+    jobid TEXT NOT NULL,
+    run TEXT NOT NULL,
+    state TEXT NOT NULL,
+    submitted REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name);
+CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid);
+CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+'''
+
+
+class JobRegistry(object):
+    '''
+    Jobs submitted by any process using the database at path.  Records
+    are written once batch_size of them are waiting, by a timer thread
+    once the oldest has waited max_delay seconds, by flush() and at exit.
+    '''
+
+    def __init__(self, path, batch_size=100, max_delay=1.0):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+        self._db = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False,
+            isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        atexit.register(self.flush)
+
+    def record(self, name, jobid, run):
+        '''
+        Queue jobid, a list for a job submitted in several parts, of the
+        job called name (None if unnamed) submitted by run
+        '''
+        jobids = jobid if isinstance(jobid, list) else [jobid]
+        now = time.time()
+        with self._lock:
+            self._pending.extend((name, str(j), run, SUBMITTED, now)
+                                 for j in jobids if j)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._pending and self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def set_state(self, jobids, state):
+        self.flush()
+        with self._lock, self._transaction():
+            self._db.executemany(
+                'UPDATE jobs SET state = ? WHERE jobid = ?',
+                [(state, str(j)) for j in jobids])
+
+    def update_from(self, waiter):
+        '''
+        Store the final states a Waiter has seen
+        '''
+        self.set_state(waiter.successful_jobs(), COMPLETED)
+        self.set_state(waiter.unsuccessful_jobs(), FAILED)
+
+    def mappings(self, run=None):
+        '''
+        ({name: jobid or list of ids}, set of unnamed job ids) of every
+        run, or only of run.  A name submitted by several runs maps to
+        the ids of the latest.
+        '''
+        self.flush()
+        query = 'SELECT name, jobid, run FROM jobs'
+        args = ()
+        if run is not None:
+            query += ' WHERE run = ?'
+            args = (run, )
+        named, unnamed = {}, set()
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY rowid', args).fetchall()
+        for name, jobid, job_run in rows:
+            if name is None:
+                unnamed.add(jobid)
+                continue
+            last_run, ids = named.get(name, (None, None))
+            if last_run != job_run:
+                named[name] = (job_run, [jobid])
+            else:
+                ids.append(jobid)
+        return ({
+            name: ids[0] if len(ids) == 1 else ids
+            for name, (_, ids) in named.items()
+        }, unnamed)
+
+    def jobs(self, state=None, run=None):
+        '''
+        (name, jobid, run, state, submitted) rows in submission order
+        '''
+        self.flush()
+        clauses, args = [], []
+        for column, value in [('state', state), ('run', run)]:
+            if value is not None:
+                clauses.append('{0} = ?'.format(column))
+                args.append(value)
+        query = 'SELECT name, jobid, run, state, submitted FROM jobs'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self._lock:
+            return self._db.execute(query + ' ORDER BY rowid', args).fetchall()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def _flush(self):
+        if self._pending:
+            with self._transaction():
+                self._db.executemany(
+                    'INSERT INTO jobs (name, jobid, run, state, submitted) '
+                    'VALUES (?, ?, ?, ?, ?)', self._pending)
+            del self._pending[:]
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _transaction(self):
+        return _Transaction(self._db)
+
+
+class _Transaction(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+@functools.lru_cache(maxsize=None)
+def shared(path):
+    '''
+    One JobRegistry per path for the whole process
+    '''
+    return JobRegistry(path)
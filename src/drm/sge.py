@@ -1,14 +1,26 @@
 from past.utils import old_div
+import getpass
 import os.path
 import os
 import re
+import threading
+from collections import OrderedDict
+from xml.etree import ElementTree
 
 import attr
 
+import drm.aio as aio
 import drm.base as base
 
 PE_NAME = os.environ.get('DRM_SGE_PE', 'smp')
 
+# None without SGE_ROOT, Waiters then need an explicit accounting file
+ACCOUNTING = None
+if os.environ.get('SGE_ROOT'):
+    ACCOUNTING = os.path.join(
+        os.environ['SGE_ROOT'],
+        os.environ.get('SGE_CELL', 'default'), 'common', 'accounting')
+
 
 @base.none_guard_filters
 def make_environment(template_dict):
@@ -39,8 +51,8 @@ template_dict = {}
 
 template_dict['resource'] = '''\
 #$ -l h_rt={{ time|format_timedelta }},\
-h_vmem={{ memInGB|format_memory }}G,mem_free={{ memInGB|format_memory }}G
-#$ -pe {{ workers|format_parallel(workers) }}
+h_vmem={{ memInGB|format_memory(workers) }}G,mem_free={{ memInGB|format_memory(workers) }}G
+#$ -pe {{ workers|format_parallel }}
 {{ constraint }}
 '''
 
@@ -58,30 +70,62 @@ template_dict['job'] = '''#!{{ shell }}
 {{ job }}
 '''
 
-_ENV = make_environment(template_dict)
+get_environment = base.lazy_environment(make_environment, template_dict)
+
+
+_ENDS_IN_NONE = re.compile(r'None\s*$')
 
 
 def remove_lines_ending_in_none(_str):
     lines = _str.split(os.linesep)
-    return os.linesep.join(e for e in lines if not re.search(r'None\s*$', e))
+    return os.linesep.join(e for e in lines if not _ENDS_IN_NONE.search(e))
 
 
 class Constraint(base.Constraint):
+    __slots__ = ()
+
     def __str__(self):
         return '{}'.format(self.features)
 
 
 class Resource(base.Resource):
-    _template = _ENV.get_template('resource')
+    __slots__ = ()
+
+    _template = base.LazyTemplate(get_environment, 'resource')
 
+    @base.cached_str
     def __str__(self):
         return remove_lines_ending_in_none(
             self._template.render(**attr.asdict(self, recurse=False)))
 
 
+class JobTemplate(object):
+    '''
+    Renders exactly what template_dict['job'] does with string joins,
+    used instead of Jinja unless DRM_FAST_RENDER=0
+    '''
+
+    def render(self, shell, job, name, workDir, logDir, jid_list, resource,
+               **kwargs):
+        shell = str(shell)
+        logDir = str(logDir)
+        jid_list = 'None' if jid_list is None else ','.join(jid_list)
+        return ''.join([
+            '#!', shell, '\n#$ -wd ', str(workDir), '\n#$ -V\n#$ -S ', shell,
+            '\n#$ -o ', logDir, '\n#$ -e ', logDir, '\n#$ -N ', str(name),
+            '\n#$ -hold_jid ', jid_list, '\n\n', str(resource), '\n\n',
+            str(job), '\n'
+        ])
+
+
 class Submitter(base.Submitter):
-    template = _ENV.get_template('job')
+    template = (JobTemplate() if base.FAST_RENDER else
+                base.LazyTemplate(get_environment, 'job'))
     submit_cmd = 'qsub'
+    transient_error = re.compile(
+        r'unable to contact qmaster|unable to send message|'
+        r'failed receiving gdi request|jobs are allowed per user|'
+        r'Maximum number of jobs|try again', re.IGNORECASE)
 
     def get_jobid_from_submit(self, stdout):
         m = re.search(r'\d+', stdout)
@@ -89,3 +133,206 @@ class Submitter(base.Submitter):
             return None
         else:
             return m.group(0)
+
+    def pending_jobs(self):
+        return base.count_pending(
+            ('qstat', '-s', 'p', '-u', getpass.getuser()),
+            lambda line: line.lstrip()[:1].isdigit())
+
+
+class AccountingTail(object):
+    '''
+    Follows an SGE accounting file like tail -f.
+
+    Every read() only parses the bytes appended since the previous one and
+    adds them to index, which maps a job number to (failed, exit_status).
+    Array tasks of a job are merged, a failed task wins.  If the file is
+    rotated (new inode or smaller than the offset) it is read from the start.
+
+    index only holds the jobs some Waiter tracks, entries go once no Waiter
+    tracks them.  The last max_recent other jobs are kept aside in case a
+    Waiter starts tracking them late.
+    '''
+    _blocksize = 2**20
+
+    def __init__(self, path, offset=0, max_recent=10000):
+        self.path = path
+        self.offset = offset
+        self.max_recent = max_recent
+        self.index = {}
+        self._tracked = {}
+        self._recent = OrderedDict()
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def track(self, jobs):
+        '''
+        Index jobs until as many untrack() calls release them
+        '''
+        with self._lock:
+            for job in jobs:
+                self._tracked[job] = self._tracked.get(job, 0) + 1
+                if job in self._recent:
+                    self.index[job] = self._recent.pop(job)
+
+    def untrack(self, jobs):
+        with self._lock:
+            for job in jobs:
+                count = self._tracked.get(job, 0) - 1
+                if count > 0:
+                    self._tracked[job] = count
+                else:
+                    self._tracked.pop(job, None)
+                    self.index.pop(job, None)
+
+    def read(self):
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return
+            if stat.st_ino != self._inode or stat.st_size < self.offset:
+                if self._inode is not None:
+                    self.offset = 0
+                self._inode = stat.st_ino
+
+            with open(self.path, 'rb') as fh:
+                fh.seek(self.offset)
+                rest = b''
+                while True:
+                    block = fh.read(self._blocksize)
+                    if not block:
+                        break
+                    lines = (rest + block).split(b'\n')
+                    rest = lines.pop()
+                    for line in lines:
+                        self._add(line)
+                        self.offset += len(line) + 1
+
+    def _add(self, line):
+        if not line or line.startswith(b'#'):
+            return
+        fields = line.split(b':', 13)
+        if len(fields) < 13:
+            return
+        job = fields[5].decode()
+        failed, exit_status = fields[11].decode(), fields[12].decode()
+        table = self.index if job in self._tracked else self._recent
+        previous = table.get(job)
+        if previous is None or previous == ('0', '0'):
+            table[job] = (failed, exit_status)
+        if table is self._recent and len(table) > self.max_recent:
+            table.popitem(last=False)
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Jobs that finished before this module was imported are not of interest
+_TAILS = {}
+if ACCOUNTING:
+    _TAILS[ACCOUNTING] = AccountingTail(ACCOUNTING, _size(ACCOUNTING))
+_TAILS_LOCK = threading.Lock()
+
+
+def get_accounting_tail(path):
+    '''
+    One shared AccountingTail per accounting file in this process,
+    starting where the file ends when it is first asked for
+    '''
+    with _TAILS_LOCK:
+        tail = _TAILS.get(path)
+        if tail is None:
+            tail = _TAILS[path] = AccountingTail(path, _size(path))
+        return tail
+
+
+@attr.s
+class Waiter(base.Waiter):
+    '''
+    Class for waiting on jobids using qstat and the accounting file
+
+    Pending and running jobs come from one qstat -xml call per poll.
+    Finished jobs come from the accounting file, which is tailed rather
+    than searched with qacct, so a poll only reads the bytes appended since
+    the previous poll.  The tail is shared by all waiters on the same file
+    and starts where the file ended when this module was imported, or for
+    other files when the first Waiter on it was made.  The offset is not
+    kept across processes: a restarted driver does not rescan the file
+    but only sees jobs finishing after it started.
+
+    A job is finished once it has left qstat and has an accounting entry,
+    jobs in an error state (Eqw) count as unsuccessful.
+    '''
+    _args = ['qstat', '-xml']
+    _cmd = base.LazyCommand(_args)
+
+    _bufsize = 2**16
+
+    accounting = attr.ib(default=ACCOUNTING)
+
+    def __attrs_post_init__(self):
+        super(Waiter, self).__attrs_post_init__()
+        if not self.accounting:
+            raise ValueError('SGE_ROOT is not set, pass the path of the '
+                             'accounting file as accounting')
+        get_accounting_tail(self.accounting).track(self._unfinished)
+
+    def query(self):
+        if not self._unfinished:
+            return self
+        chunks = self._cmd(_iter=True, _out_bufsize=self._bufsize)
+        self._apply(dict(self._jobs(chunks)))
+        return self
+
+    def _query_args(self):
+        return [self._args] if self._unfinished else []
+
+    def _parse(self, raw_data):
+        if raw_data:
+            self._apply(dict(self._jobs([raw_data])))
+        return self
+
+    def _jobs(self, chunks):
+        '''
+        (JB_job_number, state) of each job_list element qstat reports
+        '''
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        root = None
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if root is None:
+                    root = elem
+                elif event == 'end' and elem.tag == 'job_list':
+                    yield elem.findtext('JB_job_number'), elem.findtext('state')
+                    elem.clear()
+        parser.close()
+
+    def _apply(self, queued):
+        tail = get_accounting_tail(self.accounting)
+        tail.read()
+        before = set(self._unfinished)
+        for jobid in before:
+            state = queued.get(jobid)
+            finished = tail.index.get(jobid)
+            if state is not None:
+                self._update(jobid, (state, None), False if 'E' in state else None)
+            elif finished is not None:
+                failed, exit_status = finished
+                self._update(jobid, ('z', exit_status),
+                             failed == '0' and exit_status == '0')
+        tail.untrack(before - self._unfinished)
+
+
+class AsyncSubmitter(aio.AsyncSubmitter, Submitter):
+    pass
+
+
+@attr.s
+class AsyncWaiter(aio.AsyncWaiter, Waiter):
+    pass
@@ -1,18 +1,20 @@
 from __future__ import division
 from past.utils import old_div
 import os
+import functools
+import getpass
 import re
 import math
-import itertools as it
-import csv
 import logging
-import time
 from datetime import datetime
 
+from concurrent.futures import ThreadPoolExecutor
+
 import attr
-import sh
 
+import drm.aio as aio
 import drm.base as base
+import drm.metrics as metrics
 
 
 @base.none_guard_filters
@@ -36,6 +38,7 @@ def make_environment(template_dict):
     env.filters['format_timedelta'] = format_timedelta
     env.filters['format_logDir'] = format_logDir
     env.filters['format_ntasks'] = format_ntasks
+    env.filters['format_throttle'] = base.array_throttle
 
     env.tests['array'] = lambda x: isinstance(x, JobArray)
     return env
@@ -63,7 +66,7 @@ template_dict['mpi_resource'] = '''\
 
 template_dict['array'] = '''\
 {% for job in jobs %}
-if [ $SLURM_ARRAY_TASK_ID == {{ loop.index - 1 }} ]
+if [ $SLURM_ARRAY_TASK_ID == {{ loop.index - 1 }} ]; then
   {{ job }}
 fi
 {% endfor %}'''
@@ -73,7 +76,7 @@ template_dict['job'] = '''#!{{ shell }}
 #SBATCH --export=ALL
 
 {% if job is array %} 
-#SBATCH --array=0-{{ job|length - 1}}
+#SBATCH --array=0-{{ job|length - 1}}{{ job|format_throttle }}
 #SBATCH -o {{ logDir| format_logDir(script_name) }}.o%A_%a
 #SBATCH -e {{ logDir| format_logDir(script_name) }}.e%A_%a
 {% else %}
@@ -96,15 +99,20 @@ template_dict['job'] = '''#!{{ shell }}
 {{ job }}
 '''
 
-_ENV = make_environment(template_dict)
+get_environment = base.lazy_environment(make_environment, template_dict)
+
+
+_ENDS_IN_NONE = re.compile(r'None\s*$')
 
 
 def remove_lines_ending_in_none(_str):
     lines = _str.split(os.linesep)
-    return os.linesep.join(e for e in lines if not re.search(r'None\s*$', e))
+    return os.linesep.join(e for e in lines if not _ENDS_IN_NONE.search(e))
 
 
 class Constraint(base.Constraint):
+    __slots__ = ()
+
     _template = '#SBATCH --constraint {}'
 
     def __str__(self):
@@ -115,23 +123,29 @@ class Constraint(base.Constraint):
 
 
 class Resource(base.Resource):
-    _template = _ENV.get_template('resource')
+    __slots__ = ()
 
+    _template = base.LazyTemplate(get_environment, 'resource')
+
+    @base.cached_str
     def __str__(self):
         return remove_lines_ending_in_none(
             self._template.render(**attr.asdict(self, recurse=False)))
 
 
 class MpiResource(base.MpiResource):
-    _template = _ENV.get_template('mpi_resource')
+    __slots__ = ()
+
+    _template = base.LazyTemplate(get_environment, 'mpi_resource')
 
+    @base.cached_str
     def __str__(self):
         return remove_lines_ending_in_none(
             self._template.render(**attr.asdict(self, recurse=False)))
 
 
 class JobArray(base.JobArray):
-    _template = _ENV.get_template('array')
+    _template = base.LazyTemplate(get_environment, 'array')
 
     def add_job(self, job):
         self.jobs.append(job)
@@ -140,9 +154,50 @@ class JobArray(base.JobArray):
         return self._template.render(jobs=self.jobs)
 
 
+class IndexedJobArray(base.IndexedJobArray, JobArray):
+    task_id = '$SLURM_ARRAY_TASK_ID'
+
+
+_join = functools.lru_cache(maxsize=256)(os.path.join)
+
+
+class JobTemplate(object):
+    '''
+    Renders exactly what template_dict['job'] does with string joins,
+    used instead of Jinja unless DRM_FAST_RENDER=0
+    '''
+
+    def render(self, shell, job, name, workDir, logDir, script_name,
+               jid_list, resource, **kwargs):
+        log = _join(logDir, script_name)
+        parts = [
+            '#!', str(shell), '\n#SBATCH --parsable\n#SBATCH --export=ALL\n\n'
+        ]
+        if isinstance(job, JobArray):
+            parts += [' \n#SBATCH --array=0-', str(len(job) - 1),
+                      base.array_throttle(job), '\n#SBATCH -o ', log,
+                      '.o%A_%a\n#SBATCH -e ', log, '.e%A_%a\n']
+        else:
+            parts += ['#SBATCH -o ', log, '.o%j\n#SBATCH -e ', log, '.e%j\n']
+        parts += ['\n#SBATCH -D ', str(workDir), '\n\n']
+        if name is not None:
+            parts += ['#SBATCH -J ', str(name), '\n']
+        parts.append('\n')
+        if jid_list is not None:
+            parts += ['#SBATCH -d afterok:', ':'.join(jid_list), '\n']
+        parts += ['\n', str(resource), '\n\n', str(job), '\n']
+        return ''.join(parts)
+
+
 class Submitter(base.Submitter):
-    template = _ENV.get_template('job')
+    template = (JobTemplate() if base.FAST_RENDER else
+                base.LazyTemplate(get_environment, 'job'))
     submit_cmd = 'sbatch'
+    array_class = JobArray
+    indexed_array_class = IndexedJobArray
+    transient_error = re.compile(
+        r'Socket timed out|Resource temporarily unavailable|MaxSubmitJob|'
+        r'Unable to contact slurm controller|try again', re.IGNORECASE)
 
     def get_jobid_from_submit(self, stdout):
         m = re.search(r'\d+', stdout)
@@ -151,6 +206,19 @@ class Submitter(base.Submitter):
         else:
             return m.group(0)
 
+    def pending_jobs(self):
+        # -r lists every pending array task on its own line
+        return base.count_pending(
+            ('squeue', '-h', '-r', '-t', 'PENDING', '-o', '%i', '-u',
+             getpass.getuser()), bool)
+
+    def _discover_max_array_size(self):
+        '''
+        Array indexes must be below MaxArraySize
+        '''
+        return base.scheduler_setting(('scontrol', 'show', 'config'),
+                                      r'^MaxArraySize\s*=\s*(\d+)')
+
 
 @attr.s
 class Waiter(base.Waiter):
@@ -169,72 +237,131 @@ class Waiter(base.Waiter):
 
     JobID entry is mangled in the case of array jobs with a _\d+
     JobIDRaw is a job's true jobid
+
+    Array tasks are queried through their parent id and job ids are sent to
+    sacct in chunks of chunk_size, at most max_workers chunks at a time.
     '''
     _MODULE_START_TIME = datetime.utcnow()
     _time_format = '%Y-%m-%dT%H:%M:%S'
-
-    _header = ['jobidraw', 'state', 'exitcode', 'submit']
-    try:
-        _cmd = sh.Command('sacct').bake(
-            '-nDP', '--format={}'.format(','.join(_header)), '-j')
-    except sh.CommandNotFound:
-        _cmd = None
-
-    _info = attr.ib(default=attr.Factory(list))
-
-    def wait(self):
-        _timeout = self.timeout
-        N = len(self.jobid_lst)
-        while (True):
-            self.query()
-            if N > len(self.successful_jobs() + self.unsuccessful_jobs()):
-                time.sleep(self.interval)
-            else:
-                return self
-            if _timeout is not None:
-                _timeout -= self.interval
-                if _timeout <= 0:
-                    return self
-
+    _start_string = _MODULE_START_TIME.strftime(_time_format)
+
+    _failed_states = ['FAIL', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'DEADLINE']
+    _final_states = [
+        'BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED',
+        'NODE_FAIL', 'OUT_OF_MEMORY', 'TIMEOUT'
+    ]
+
+    # Only jobs that reached a final state after this module was imported
+    # are returned, anything else is still unfinished
+    _header = ['jobidraw', 'state', 'exitcode', 'submit', 'jobid']
+    _args = [
+        'sacct', '-nDP', '--format={}'.format(','.join(_header)),
+        '--starttime={}'.format(_start_string),
+        '--state={}'.format(','.join(_final_states)), '-j'
+    ]
+    _cmd = base.LazyCommand(_args)
+
+    chunk_size = attr.ib(default=1000)
+    max_workers = attr.ib(default=4)
+
+    @metrics.timed('poll')
     def query(self):
         # sacct returns all jobs if -j is empty string, avoid this
-        if not self.jobid_lst:
-            self._info = []
-        jobs = ','.join(self.jobid_lst)
-        raw_data = self._cmd(jobs).stdout
-
-        _iter = csv.DictReader(
-            raw_data.split('\n'), delimiter='|', fieldnames=self._header)
-
-        self._info = [
-            line for line in _iter
-            if not self._is_entry_batch(line['jobidraw'])
-            and self._is_submit_in_range(line['submit'])
-        ]
-        self._check_for_duplicates()
+        chunks = self._chunks()
+        if len(chunks) <= 1:
+            for jobs in chunks:
+                self._apply(self._stream(jobs))
+            return self
+
+        workers = min(self.max_workers, len(chunks))
+        with ThreadPoolExecutor(workers) as pool:
+            for latest in pool.map(self._stream, chunks):
+                self._apply(latest)
         return self
 
-    def unsuccessful_jobs(self):
-        def cond(s):
-            return any(st in s for st in ['FAIL', 'CANCELLED', 'TIMEOUT'])
+    def _query_args(self):
+        return [self._args + [jobs] for jobs in self._chunks()]
+
+    def _chunks(self):
+        '''
+        Comma joined ids of unfinished jobs with array tasks collapsed
+        to their parent
+        '''
+        ids = sorted(set(jobid.split('_')[0] for jobid in self._unfinished))
+        size = max(1, self.chunk_size)
+        return [
+            ','.join(ids[i:i + size]) for i in range(0, len(ids), size)
+        ]
 
-        return [job['jobidraw'] for job in self._info if cond(job['state'])]
+    def _stream(self, jobs):
+        '''
+        Consume sacct output line by line as it is produced
+        '''
+        return self._latest(self._cmd(jobs, _iter=True))
 
-    def successful_jobs(self):
-        def cond(s):
-            return 'COMPLETED' in s
+    def _parse(self, raw_data):
+        self._apply(self._latest(raw_data.split('\n')))
+        return self
 
-        return [job['jobidraw'] for job in self._info if cond(job['state'])]
+    def _latest(self, lines):
+        '''
+        Most recent (state, exitcode) of every unfinished job in lines,
+        with duplicates the most recent entry wins
+        '''
+        latest = {}
+        for jobidraw, state, exitcode, submit, jobid in self._rows(lines):
+            if not self._is_submit_in_range(submit):
+                continue
+            if jobid not in self._unfinished:
+                jobid = jobidraw
+            if jobid in latest:
+                logging.critical('JobIDRaw %s has multiple entries', jobid)
+            latest[jobid] = (state, exitcode)
+        return latest
+
+    def _rows(self, lines):
+        '''
+        Compact tuples in _header order from sacct output lines.  Job steps
+        are dropped before the rest of the line is split.
+        '''
+        n = 0
+        for n, line in enumerate(lines, 1):
+            jobidraw, sep, rest = line.partition('|')
+            if not sep or self._is_entry_batch(jobidraw):
+                continue
+            fields = rest.rstrip('\r\n').split('|')
+            if len(fields) < 3:
+                continue
+            jobid = fields[3] if len(fields) > 3 else None
+            yield jobidraw, fields[0], fields[1], fields[2], jobid
+        metrics.observe('poll_lines', n)
+
+    def _apply(self, latest):
+        for jobid, info in latest.items():
+            if jobid in self._unfinished:
+                self._update(jobid, info, self._is_successful(info[0]))
+
+    def _is_successful(self, state):
+        if 'COMPLETED' in state:
+            return True
+        elif any(st in state for st in self._failed_states):
+            return False
+        else:
+            return None
 
     def _is_entry_batch(self, jobid):
-        return 'batch' in jobid
+        # .batch, .extern and numbered job steps
+        return '.' in jobid
 
     def _is_submit_in_range(self, submit_time):
-        submit = datetime.strptime(submit_time, self._time_format)
-        return submit >= self._MODULE_START_TIME
-
-    def _check_for_duplicates(self):
-        _ids = sorted(e['jobidraw'] for e in self._info)
-        for k, grp in it.groupby(_ids):
-            if len(list(grp)) > 1:
-                logging.critical('JobIDRaw %s has multiple entries', k)
+        # fixed width ISO 8601 strings sort like the times they represent
+        return submit_time >= self._start_string
+
+
+class AsyncSubmitter(aio.AsyncSubmitter, Submitter):
+    pass
+
+
+@attr.s
+class AsyncWaiter(aio.AsyncWaiter, Waiter):
+    pass
@@ -0,0 +1,351 @@
+'''
+slurm through the slurmrestd REST API instead of forking sbatch and sacct.
+
+Scripts are rendered exactly as for the slurm backend, their #SBATCH
+lines are turned into the job description slurmrestd needs (it does not
+read them from the script).  Requests go over a small pool of persistent
+HTTP/1.1 connections, to a TCP or unix socket address:
+
+    DRM_SLURMRESTD_URL=http://head:6820 or unix:///run/slurmrestd.socket
+    DRM_SLURMRESTD_VERSION=v0.0.39
+    SLURM_JWT=<token from scontrol token>
+
+A Waiter asks for every job with one GET of /jobs.  That only knows jobs
+slurmctld still keeps in memory (see MinJobAge), jobs it no longer lists
+are looked up in slurmdbd and failed if it does not know them either.
+'''
+import getpass
+import json
+import logging
+import os
+import queue
+import re
+import select
+import socket
+import threading
+from http import client as http_client
+from urllib.parse import urlsplit
+
+import attr
+
+import drm.base as base
+import drm.metrics as metrics
+import drm.slurm as slurm
+from drm.slurm import (Constraint, Resource, MpiResource, JobArray,
+                       IndexedJobArray)
+
+logger = logging.getLogger(__name__)
+
+URL = os.environ.get('DRM_SLURMRESTD_URL', 'http://localhost:6820')
+VERSION = os.environ.get('DRM_SLURMRESTD_VERSION', 'v0.0.39')
+
+__all__ = [
+    'Constraint', 'Resource', 'MpiResource', 'JobArray', 'IndexedJobArray',
+    'Submitter', 'Waiter', 'RestClient', 'SlurmRestError', 'get_client'
+]
+
+
+class SlurmRestError(RuntimeError):
+    '''
+    slurmrestd answered with an error status or a non empty errors list
+    '''
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RestClient(object):
+    '''
+    JSON requests to slurmrestd at url over at most pool_size persistent
+    connections, safe to share between threads.  Idle connections the
+    server has closed are replaced before use.  A request failing on a
+    reused connection is sent again on a new one only if it is a GET or
+    it failed before being sent, so a submission is never made twice.
+    '''
+
+    def __init__(self, url=URL, version=VERSION, token=None, user=None,
+                 pool_size=4, timeout=60):
+        self.url = url
+        self.version = version
+        self.timeout = timeout
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'X-SLURM-USER-NAME': user or getpass.getuser(),
+        }
+        token = token or os.environ.get('SLURM_JWT')
+        if token:
+            self.headers['X-SLURM-USER-TOKEN'] = token
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def submit(self, script, job):
+        '''
+        Submit script with the job description job, returns the job id
+        '''
+        reply = self.request('POST', 'job/submit',
+                             {'script': script, 'job': job})
+        return str(reply['job_id'])
+
+    def jobs(self):
+        return self.request('GET', 'jobs').get('jobs', [])
+
+    def accounting(self, jobid):
+        '''
+        slurmdbd records of jobid, for an array job those of its tasks
+        '''
+        return self.request('GET', 'job/{0}'.format(jobid),
+                            api='slurmdb').get('jobs', [])
+
+    def request(self, method, path, body=None, api='slurm'):
+        path = '/{0}/{1}/{2}'.format(api, self.version, path)
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        with self._slots:
+            conn, reused = self._connection()
+            try:
+                status, payload = self._send(conn, method, path, data,
+                                             retry=reused)
+            except _Unsent:
+                conn.close()
+                conn = self._connect()
+                status, payload = self._send(conn, method, path, data)
+            except (http_client.HTTPException, OSError):
+                conn.close()
+                if not (reused and method == 'GET'):
+                    raise
+                conn = self._connect()
+                status, payload = self._send(conn, method, path, data)
+            self._idle.put(conn)
+
+        reply = json.loads(payload.decode('utf-8')) if payload else {}
+        errors = [e for e in reply.get('errors', []) if e]
+        if status >= 400 or errors:
+            raise SlurmRestError('{0} {1}: {2} {3}'.format(
+                method, path, status, errors or payload.decode('utf-8')))
+        for warning in reply.get('warnings', []):
+            logger.warning('slurmrestd: %s', warning)
+        return reply
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
+
+    def _send(self, conn, method, path, data, retry=False):
+        '''
+        With retry, failures before the request left raise _Unsent
+        '''
+        try:
+            conn.request(method, path, body=data, headers=self.headers)
+        except (http_client.HTTPException, OSError):
+            if retry:
+                raise _Unsent()
+            raise
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def _connection(self):
+        '''
+        (connection, whether it was used before), idle connections that
+        the server closed (readable while idle) are dropped
+        '''
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), False
+            if conn.sock is None:
+                return conn, True
+            if not select.select([conn.sock], [], [], 0)[0]:
+                return conn, True
+            conn.close()
+
+    def _connect(self):
+        parts = urlsplit(self.url)
+        if parts.scheme == 'unix':
+            return UnixHTTPConnection(parts.path, self.timeout)
+        if parts.scheme == 'https':
+            return http_client.HTTPSConnection(parts.hostname, parts.port,
+                                               timeout=self.timeout)
+        return http_client.HTTPConnection(parts.hostname, parts.port or 80,
+                                          timeout=self.timeout)
+
+
+class _Unsent(Exception):
+    pass
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(url=None):
+    '''
+    The RestClient of url, DRM_SLURMRESTD_URL by default, shared by the
+    whole process
+    '''
+    url = url or URL
+    with _CLIENTS_LOCK:
+        if url not in _CLIENTS:
+            _CLIENTS[url] = RestClient(url)
+        return _CLIENTS[url]
+
+
+_DIRECTIVE = re.compile(r'^#SBATCH\s+(-[-\w]+)(?:[=\s]+(.*?))?\s*$',
+                        re.MULTILINE)
+
+
+def _minutes(limit):
+    '''
+    Minutes of a slurm time limit, [days-]hours:minutes:seconds
+    '''
+    days, _, clock = limit.rpartition('-')
+    parts = [int(p) for p in clock.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    hours, minutes, seconds = parts
+    return ((int(days or 0) * 24 + hours) * 60 + minutes +
+            (1 if seconds else 0))
+
+
+# sbatch option -> (job description field, conversion)
+_OPTIONS = {
+    '-t': ('time_limit', _minutes),
+    '--mem': ('memory_per_node', int),
+    '-c': ('cpus_per_task', int),
+    '--cpus-per-task': ('cpus_per_task', int),
+    '--ntasks': ('tasks', int),
+    '--ntasks-per-node': ('tasks_per_node', int),
+    '--constraint': ('constraints', str),
+    '--array': ('array', str),
+    '-o': ('standard_output', str),
+    '-e': ('standard_error', str),
+    '-D': ('current_working_directory', str),
+    '-J': ('name', str),
+    '-d': ('dependency', str),
+}
+
+
+def job_description(script, environ=None):
+    '''
+    The slurmrestd job description of the #SBATCH lines of script
+    '''
+    environ = os.environ if environ is None else environ
+    job = {}
+    export = None
+    for option, value in _DIRECTIVE.findall(script):
+        if option == '--parsable':
+            continue
+        if option == '--export':
+            export = value
+            continue
+        if option not in _OPTIONS:
+            raise ValueError('#SBATCH {0} is not supported by slurmrestd '
+                             'submission'.format(option))
+        field, convert = _OPTIONS[option]
+        job[field] = convert(value)
+
+    if export in (None, 'ALL'):
+        job['environment'] = ['{0}={1}'.format(k, v)
+                              for k, v in sorted(environ.items())]
+    else:
+        job['environment'] = [
+            '{0}={1}'.format(k, environ[k]) for k in export.split(',')
+            if k in environ
+        ]
+    job.setdefault('current_working_directory', os.getcwd())
+    return job
+
+
+class Submitter(slurm.Submitter):
+    '''
+    slurm.Submitter submitting through slurmrestd, client is the
+    RestClient to use instead of the shared one of get_client()
+    '''
+    client = None
+
+    @metrics.timed('submit_cmd')
+    def _submit(self, script_fp):
+        if isinstance(script_fp, base.ScriptText):
+            script = script_fp.text()
+        else:
+            with open(script_fp) as fh:
+                script = fh.read()
+        client = self.client or get_client()
+        return client.submit(script, job_description(script))
+
+
+def _number(value):
+    '''
+    Newer API versions wrap numbers as {"set": true, "number": n}
+    '''
+    if isinstance(value, dict):
+        return value.get('number') if value.get('set', True) else None
+    return value
+
+
+@attr.s
+class Waiter(slurm.Waiter):
+    '''
+    slurm.Waiter asking slurmrestd, every query is a single GET of /jobs
+    '''
+    client = attr.ib(default=None)
+
+    @metrics.timed('poll')
+    def query(self):
+        if not self._unfinished:
+            return self
+        client = self.client or get_client()
+        jobs = client.jobs()
+        metrics.observe('poll_lines', len(jobs))
+        latest = self._latest_rest(jobs)
+        self._apply(latest)
+
+        # aged out of slurmctld, ask slurmdbd once per job or array, jobs
+        # it could not be asked about are tried again next poll
+        missing = sorted(set(j.split('_')[0] for j in self._unfinished
+                             if j not in latest))
+        answered = set()
+        for jobid in missing:
+            try:
+                self._apply(self._latest_rest(client.accounting(jobid)))
+            except SlurmRestError as err:
+                logger.warning('no accounting for job %s: %s', jobid, err)
+            else:
+                answered.add(jobid)
+        for jobid in list(self._unfinished):
+            if jobid not in latest and jobid.split('_')[0] in answered:
+                self._update(jobid, ('UNKNOWN', ''), False)
+        return self
+
+    def _latest_rest(self, jobs):
+        '''
+        (state, exit code) of every job and array task, keyed by its
+        job id and for tasks also by <array job id>_<task id>.  Reads the
+        records of /jobs as well as those of slurmdbd.
+        '''
+        latest = {}
+        for job in jobs:
+            state = job.get('job_state', job.get('state'))
+            if isinstance(state, dict):
+                state = state.get('current')
+            if isinstance(state, list):
+                state = ','.join(state)
+            exitcode = job.get('exit_code')
+            if isinstance(exitcode, dict):
+                exitcode = _number(exitcode.get('return_code', exitcode))
+            info = (state or '', str(exitcode))
+            latest[str(_number(job.get('job_id')))] = info
+            array = job.get('array', {})
+            array_id = _number(job.get('array_job_id', array.get('job_id')))
+            task_id = _number(job.get('array_task_id', array.get('task_id')))
+            if array_id and task_id is not None:
+                latest['{0}_{1}'.format(array_id, task_id)] = info
+        return latest
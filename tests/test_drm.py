@@ -5,15 +5,25 @@ from builtins import map
 from builtins import next
 from builtins import range
 from builtins import object
+import asyncio
 import pytest
 import re
 import os
 import time
 import pickle
+import json
+import select
+import socket
+import subprocess
+import threading
+import sys
+import attr
 from io import BytesIO
+from http import client as http_client
 from datetime import timedelta, datetime
 from path import Path
-from drm import pbs, base, slurm, bash
+import drm
+from drm import aio, pbs, base, sge, slurm, slurmrest, bash, dag, metrics, registry
 
 SHELL = base.Submitter.shell
 
@@ -22,21 +32,41 @@ class FakeProcess(object):
     def __init__(self, stdout):
         self.stdout = str(stdout)
 
+    def __iter__(self):
+        return iter(self.stdout.splitlines(True))
+
+
+@pytest.fixture
+def new_process(monkeypatch):
+    '''
+    reset(*modules) gives the Submitters of modules empty name maps, as
+    in a process that has not submitted anything
+    '''
+
+    def reset(*modules):
+        for module in modules:
+            monkeypatch.setattr(module.Submitter, '_JOB_NAME_TO_ID', {})
+            monkeypatch.setattr(module.Submitter, '_NO_NAME_JOBS', set())
+            monkeypatch.setattr(module.Submitter, '_RESERVED_NAMES', set())
+            monkeypatch.setattr(module.Submitter, '_SKIPPED_NAMES', set())
+
+    return reset
+
 
 #I think this runs for every test so jid should be new everytime
 @pytest.fixture(autouse=True)
-def no_submit(monkeypatch):
+def no_submit(monkeypatch, new_process):
 
     jid = iter(range(1, 100))
 
     def mocksubmit(self, fp):
         return FakeProcess(next(jid))
 
-    for module in [pbs, slurm]:
+    for module in [pbs, sge, slurm]:
         monkeypatch.setattr(module.Submitter, '_submit', mocksubmit)
-        #reset the job_id dict between module tests
-        monkeypatch.setattr(module.Submitter, '_JOB_NAME_TO_ID', {})
-        monkeypatch.setattr(module.Submitter, '_NO_NAME_JOBS', set())
+
+    #reset the job_id dict between module tests
+    new_process(bash, pbs, sge, slurm)
 
 
 @pytest.fixture
@@ -51,7 +81,7 @@ def no_query(monkeypatch):
     time_string = datetime.utcnow().strftime(slurm.Waiter._time_format)
     sacct_data = sacct_data.format(time_string)
 
-    def mockcmd(self, jobs):
+    def mockcmd(self, jobs, **kwargs):
         # only take lines that have jobids actually mentioned unless
         # no jobids passed then return everything
         if not jobs:
@@ -70,6 +100,13 @@ def tmpdirs(tmpdir_factory):
     return tmpdir_factory.mktemp('scripts'), tmpdir_factory.mktemp('log')
 
 
+def fake_command(directory, name, body):
+    fp = Path(str(directory)).joinpath(name)
+    fp.write_text('#!/bin/sh\n{0}\n'.format(body))
+    fp.chmod(0o755)
+    return fp
+
+
 # yapf: disable
 @pytest.mark.parametrize('module,kwargs,expected', [
     (pbs, {
@@ -165,8 +202,10 @@ def test_bash_submit(tmpdirs):
     submit = bash.Submitter(script=script_dir, log=log_dir)
     # Test that nothing is done for empty job
     assert submit.submit_job('', name='test', hold='testA') is None
-    fp = submit.submit_job('echo hello', name='test', hold='testA').script
+    info = submit.submit_job('echo hello', name='test', hold='testA')
+    fp = info.script
     script = open(fp, 'r').read()
+    bash.Waiter(info.id).wait()
 
     assert fp == Path(script_dir).joinpath(
         submit.script_name_join.join(['test', submit.uid]))
@@ -176,6 +215,15 @@ def test_bash_submit(tmpdirs):
     assert re.search(r'^hello$', output)
 
 
+def test_bash_parse_directives():
+    script = ('#!/bin/bash\n#DRM -J name\n\n# comment\n#DRM --mem=2\n'
+              'echo "#DRM -t 60"\n#DRM -c 4\n')
+    expected = {'#!': '/bin/bash', '-J': 'name', '--mem': '2'}
+    assert bash.parse_directives(script) == expected
+    # lines as read from a file
+    assert bash.parse_directives(script.splitlines(True)) == expected
+
+
 def test_slurm_submit(tmpdirs):
     script_dir, log_dir = tmpdirs
     submit = slurm.Submitter(script=script_dir, log=log_dir)
@@ -274,16 +322,26 @@ def test_array_submit(tmpdirs, module, expected):
     array = module.JobArray()
     array.add_job('./job1')
     fp = submit.submit_job(array, name='first').script
-    assert search([expected[0], '== 0 ]\s+./job1'], fp.text())
+    assert search([expected[0], r'== 0 \]; then\s+./job1'], fp.text())
 
     array.add_job('./job2')
     fp2 = submit.submit_job(array, name='second').script
-    assert search([expected[1], '== 0 ]\s+./job1', '== 1 ]\s+./job2'],
+    assert search([expected[1], r'== 0 \]; then\s+./job1',
+                   r'== 1 \]; then\s+./job2'],
                   fp2.text())
 
     assert submit.submit_job(module.JobArray(), name='third') is None
 
 
+@pytest.mark.parametrize('module', [slurm, pbs, bash])
+def test_array_script_syntax(tmpdirs, module):
+    script_dir, log_dir = tmpdirs
+    submit = module.Submitter(script=script_dir, log=log_dir)
+    array = module.JobArray(['echo a', 'echo "b c"\necho d'])
+    fp = submit._write_script(array, 'syntax', None, None, '')
+    subprocess.check_call(['bash', '-n', str(fp)])
+
+
 @pytest.mark.parametrize('module,flag', [
     (pbs, 'walltime'),
     (slurm, '-t'),
@@ -294,6 +352,90 @@ def test_empty_resources(tmpdirs, module, flag):
     assert flag not in str(module.Resource(time=None))
 
 
+@pytest.mark.parametrize('module', [bash, pbs, sge, slurm])
+def test_resource_cached(module):
+    resource = module.Resource(workers=2)
+    assert resource == module.Resource(workers=2)
+    assert len({resource, module.Resource(workers=2)}) == 1
+    assert not hasattr(resource, '__dict__')
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        resource.workers = 3
+
+    cache = module.Resource.__str__.cache
+    cache.cache_clear()
+    text = str(resource)
+    assert str(module.Resource(workers=2)) == text
+    assert cache.cache_info().hits == 1
+
+    # unhashable values still render, uncached
+    unhashable = module.Resource(constraint=module.Constraint(['a']))
+    assert str(unhashable) == str(unhashable)
+    assert cache.cache_info().currsize == 1
+
+
+@pytest.mark.parametrize('module', [pbs, sge, slurm])
+def test_fast_template(tmpdirs, module):
+    jinja = module.get_environment().get_template('job')
+    fast = module.JobTemplate()
+
+    jobs = ['ls']
+    if hasattr(module, 'JobArray'):
+        jobs.append(module.JobArray(['ls a', 'ls b']))
+        jobs.append(module.JobArray(['ls a', 'ls b'], throttle=4))
+
+    resources = ['', module.Resource(), module.Resource(workers=4)]
+    if hasattr(module, 'MpiResource'):
+        resources.append(module.MpiResource(workers=8, ppn=2))
+
+    for job in jobs:
+        for name in [None, 'name']:
+            for jid_list in [None, ['1'], ['1', '2']]:
+                for resource in resources:
+                    kwargs = dict(
+                        shell=SHELL,
+                        job=job,
+                        name=name,
+                        hold=None,
+                        workDir=Path(str(tmpdirs[0])),
+                        logDir=Path(str(tmpdirs[1])),
+                        script_name=name or 'job',
+                        jid_list=jid_list,
+                        resource=resource)
+                    assert fast.render(**kwargs) == jinja.render(**kwargs)
+
+
+
+def test_get_drm_module(monkeypatch):
+    import shutil
+    calls = []
+
+    def which(cmd):
+        calls.append(cmd)
+        return '/usr/bin/sbatch' if cmd == 'sbatch' else None
+
+    monkeypatch.setattr(shutil, 'which', which)
+    monkeypatch.setattr(drm, '_DETECTED', None)
+    monkeypatch.delenv('DRM_BACKEND', raising=False)
+
+    assert drm.get_drm_module() is slurm
+    assert drm.get_drm_module() is slurm
+    assert calls == ['pbsnodes', 'qacct', 'sbatch']
+
+    monkeypatch.setenv('DRM_BACKEND', 'pbs')
+    assert drm.get_drm_module() is pbs
+    monkeypatch.setenv('DRM_BACKEND', 'lsf')
+    with pytest.raises(ValueError):
+        drm.get_drm_module()
+
+
+def test_lazy_import():
+    code = ('import sys, drm.slurm, drm.pbs, drm.sge; '
+            'print(sorted(m for m in ["jinja2", "sh", "asyncio", "path"] '
+            'if m in sys.modules))')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(drm.__path__[0]))
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert out.decode().strip() == '[]'
+
 @pytest.mark.parametrize('module', [
     slurm,
 ])
@@ -341,3 +483,1228 @@ def test_waiter_start_time_pickle():
     fh.seek(0)
     loaded = pickle.load(fh)
     assert waiter._MODULE_START_TIME == loaded._MODULE_START_TIME
+
+
+@pytest.mark.parametrize('module,expected', [
+    (slurm, ['1_0', '1_1', '2', '3_0', '3_1']),
+    (pbs, ['1[0]', '1[1]', '2', '3[0]', '3[1]']),
+])
+def test_submit_many(tmpdirs, module, expected):
+    script_dir, log_dir = tmpdirs
+    submit = module.Submitter(script=script_dir, log=log_dir)
+
+    big = module.Resource(memInGB=10)
+    infos = submit.submit_many([
+        {'job': 'ls a', 'name': 'a'},
+        {'job': 'ls b', 'name': 'b'},
+        {'job': 'ls c', 'name': 'c', 'resource': big},
+        '',
+        {'job': 'ls d', 'name': 'd', 'hold': ['a', 'b']},
+        {'job': 'ls e', 'hold': ['b', 'a']},
+    ])
+
+    assert infos[3] is None
+    ids = [info.id for i, info in enumerate(infos) if i != 3]
+    assert ids == expected
+    assert infos[0].script == infos[1].script
+    assert infos[4].script == infos[5].script
+
+    for name, jid in zip('abcd', expected):
+        assert submit._JOB_NAME_TO_ID[name] == jid
+    assert expected[4] in submit._NO_NAME_JOBS
+
+    text = infos[0].script.text()
+    assert re.search(r'== 0 \]; then\s+ls a', text)
+    assert re.search(r'== 1 \]; then\s+ls b', text)
+    assert 'ls c' not in text
+    assert ':'.join(expected[:2]) in infos[4].script.text()
+
+    # names must be unique across and within a batch
+    with pytest.raises(RuntimeError):
+        submit.submit_many([{'job': 'ls', 'name': 'a'}])
+    with pytest.raises(RuntimeError):
+        submit.submit_many([{'job': 'ls', 'name': 'f'},
+                            {'job': 'ls', 'name': 'f'}])
+    assert 'f' not in submit._JOB_NAME_TO_ID
+
+
+@pytest.mark.parametrize('module,stdout,expected', [
+    (slurm, 'Submitted batch job 42', '42'),
+    (pbs, '42.server', '42.server'),
+    (sge, 'Your job 42 ("ls") has been submitted', '42'),
+])
+def test_async_submit(tmpdirs, monkeypatch, module, stdout, expected):
+    script_dir, log_dir = tmpdirs
+    cmd = fake_command(script_dir, 'fake_submit', 'echo \'{0}\''.format(stdout))
+    monkeypatch.setattr(module.AsyncSubmitter, 'submit_cmd', cmd)
+    submit = module.AsyncSubmitter(script=script_dir, log=log_dir)
+
+    async def submit_all():
+        return await asyncio.gather(*[
+            submit.submit_job('ls', name='async{0}'.format(i))
+            for i in range(10)
+        ])
+
+    infos = asyncio.run(submit_all())
+    assert [info.id for info in infos] == [expected] * 10
+    assert submit._JOB_NAME_TO_ID['async3'] == expected
+    assert asyncio.run(submit.submit_job('')) is None
+
+
+def test_async_run_command(tmpdirs):
+    import sh
+    script_dir, _ = tmpdirs
+    with pytest.raises(sh.CommandNotFound):
+        asyncio.run(aio.run_command([Path(str(script_dir)).joinpath('no')]))
+
+    # only a missing command is CommandNotFound
+    cmd = fake_command(script_dir, 'not_executable', 'echo 1')
+    cmd.chmod(0o644)
+    with pytest.raises(PermissionError):
+        asyncio.run(aio.run_command([cmd]))
+
+
+def test_async_concurrency_cap(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    cmd = fake_command(script_dir, 'fake_sbatch', 'sleep 0.2; echo 1')
+    monkeypatch.setattr(slurm.AsyncSubmitter, 'submit_cmd', cmd)
+    monkeypatch.setattr(aio, 'MAX_CONCURRENT', 2)
+    submit = slurm.AsyncSubmitter(script=script_dir, log=log_dir)
+
+    async def submit_all():
+        return await asyncio.gather(*[
+            submit.submit_job('ls', name='cap{0}'.format(i)) for i in range(4)
+        ])
+
+    start = time.time()
+    asyncio.run(submit_all())
+    assert time.time() - start >= 0.4
+
+
+def test_async_waiter(tmpdirs, monkeypatch):
+    script_dir, _ = tmpdirs
+    now = datetime.utcnow().strftime(slurm.Waiter._time_format)
+    sacct = fake_command(
+        script_dir, 'fake_sacct',
+        'printf "1|COMPLETED|0:0|{0}\\n2|FAILED|1:0|{0}\\n"'.format(now))
+    monkeypatch.setattr(slurm.AsyncWaiter, '_args', [sacct, '-j'])
+
+    waiter = slurm.AsyncWaiter(['1', '2'], interval=1, timeout=5)
+    start = time.time()
+    asyncio.run(waiter.wait())
+    assert time.time() - start < 1
+    assert waiter.successful_jobs() == ['1']
+    assert waiter.unsuccessful_jobs() == ['2']
+
+
+@pytest.mark.parametrize('module', [pbs, slurm])
+def test_submit_parallel(tmpdirs, monkeypatch, module):
+    script_dir, log_dir = tmpdirs
+    jid = iter(range(1, 100))
+
+    def slowsubmit(self, fp):
+        time.sleep(0.1)
+        return FakeProcess(next(jid))
+
+    monkeypatch.setattr(module.Submitter, '_submit', slowsubmit)
+    submit = module.Submitter(script=script_dir, log=log_dir)
+
+    jobs = [{'job': 'ls', 'name': 'p{0}'.format(i)} for i in range(8)]
+    jobs += ['ls'] * 8 + ['']
+    start = time.time()
+    infos = submit.submit_parallel(jobs, max_workers=8)
+    assert time.time() - start < 0.8
+
+    assert infos[-1] is None
+    ids = [info.id for info in infos[:-1]]
+    assert sorted(ids, key=int) == [str(i) for i in range(1, 17)]
+    for i, info in enumerate(infos[:8]):
+        assert submit._JOB_NAME_TO_ID['p{0}'.format(i)] == info.id
+
+    # anonymous jobs get their own script
+    assert len(set(info.script for info in infos[:-1])) == 16
+    assert not submit._RESERVED_NAMES
+
+
+@pytest.mark.parametrize('module', [pbs, slurm])
+def test_concurrent_same_name(tmpdirs, monkeypatch, module):
+    script_dir, log_dir = tmpdirs
+    submitted = []
+
+    def slowsubmit(self, fp):
+        time.sleep(0.1)
+        submitted.append(fp)
+        return FakeProcess(len(submitted))
+
+    monkeypatch.setattr(module.Submitter, '_submit', slowsubmit)
+    submit = module.Submitter(script=script_dir, log=log_dir)
+
+    with pytest.raises(RuntimeError):
+        submit.submit_parallel([{'job': 'ls', 'name': 'same'}] * 2)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(4) as pool:
+        futures = [
+            pool.submit(submit.submit_job, 'ls', name='same') for _ in range(4)
+        ]
+    errors = [f for f in futures if f.exception() is not None]
+    assert len(errors) == 3
+    assert len(submitted) == 1
+    assert not submit._RESERVED_NAMES
+
+
+def test_dag_waves():
+    long = slurm.Resource(time=timedelta(hours=10))
+    d = dag.DAG()
+    d.add_job('a', 'ls a')
+    d.add_job('b', 'ls b', resource=long)
+    d.add_job('c', 'ls c', after=['a'])
+    d.add_job('d', 'ls d', after=['b', 'c'])
+    d.add_job('e', 'ls e', after=['b', 'external'])
+
+    assert d.waves() == [['b', 'a'], ['c', 'e'], ['d']]
+    assert d.critical_path()['b'] == 36001
+    assert set(d.subgraph('c')) == {'c', 'd'}
+
+    d.add_edge('d', 'a')
+    with pytest.raises(ValueError):
+        d.waves()
+    with pytest.raises(RuntimeError):
+        d.add_job('a', 'ls')
+
+
+def test_dag_submit(tmpdirs):
+    script_dir, log_dir = tmpdirs
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+
+    d = dag.DAG()
+    for name in 'abc':
+        d.add_job(name, 'ls ' + name)
+    d.add_job('d', 'ls d', after=['a', 'b', 'c'])
+    infos = d.submit(submit)
+
+    # a, b and c go out as one array job that d holds on
+    assert infos['a'].script == infos['c'].script
+    assert submit._JOB_NAME_TO_ID['b'] == '1_1'
+    assert '1_0:1_1:1_2' in infos['d'].script.text()
+
+    # re-running c and d holds on the jobs submitted before
+    infos = d.submit(submit, rerun='c')
+    assert sorted(infos) == ['c', 'd']
+    assert infos['c'].id == '3'
+    assert '1_0:1_1:3' in infos['d'].script.text()
+
+
+def test_backoff_delays():
+    delays = base.Backoff(initial=1, factor=2, cap=5, jitter=0).delays()
+    assert [next(delays) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+    delays = base.Backoff(initial=10, cap=20, jitter=0.5).delays()
+    assert 5 <= next(delays) <= 15
+    assert all(10 <= next(delays) <= 20 for _ in range(20))
+
+    policy = base.Backoff.for_resource(slurm.Resource(time=timedelta(hours=1)))
+    assert policy.cap == 180
+    policy = base.Backoff.for_resource(slurm.Resource(time=timedelta(days=9)))
+    assert policy.cap == 600
+    policy = base.Backoff.for_resource(slurm.Resource(time=None), cap=7)
+    assert policy.cap == 7
+    hour = slurm.Resource(time=timedelta(hours=1))
+    assert base.Backoff.for_resource(hour, cap=100).cap == 100
+    assert base.Backoff.for_resource(hour, cap=1000).cap == 180
+
+
+def test_wait_deadline_includes_query(no_query, monkeypatch):
+    query = slurm.Waiter.query
+
+    def slowquery(self):
+        time.sleep(0.3)
+        return query(self)
+
+    monkeypatch.setattr(slurm.Waiter, 'query', slowquery)
+    start = time.time()
+    slurm.Waiter(['4'], timeout=1, policy=base.FixedInterval(0.5)).wait()
+    assert 1 <= time.time() - start < 1.5
+
+
+def test_wait_backoff(no_query):
+    waiter = slurm.Waiter(['4'], timeout=0.5,
+                          policy=base.Backoff(initial=0.01, jitter=0))
+    polls = []
+    waiter.query = lambda: polls.append(time.time())
+    waiter.finished = lambda: False
+    waiter.wait()
+    # 0.01, 0.02, 0.04 ... reaches the deadline after about 6 sleeps
+    assert 6 <= len(polls) <= 8
+
+
+def test_slurm_waiter_incremental(no_query, monkeypatch):
+    asked = []
+    mockcmd = slurm.Waiter._cmd
+
+    def recordcmd(self, jobs, **kwargs):
+        asked.append(set(jobs.split(',')))
+        return mockcmd(self, jobs, **kwargs)
+
+    monkeypatch.setattr(slurm.Waiter, '_cmd', recordcmd)
+    waiter = slurm.Waiter(list(map(str, list(range(1, 7)))))
+
+    waiter.query()
+    waiter.query()
+    assert asked == [set('123456'), set('146')]
+    assert sorted(waiter.unfinished_jobs()) == ['1', '4', '6']
+    assert waiter._info['4'] == ('PENDING', '0:0')
+    assert not waiter.finished()
+
+    waiter = slurm.Waiter(['2', '3'])
+    waiter.query()
+    assert waiter.finished()
+    waiter.query()
+    assert len(asked) == 3
+
+
+def test_slurm_sacct_filters():
+    args = ' '.join(slurm.Waiter._args)
+    start = slurm.Waiter._MODULE_START_TIME.strftime(slurm.Waiter._time_format)
+    assert '--starttime={0}'.format(start) in args
+    assert re.search(r'--state=\S*COMPLETED', args)
+    assert args.endswith('-j')
+
+
+def test_slurm_waiter_chunks(no_query, monkeypatch):
+    asked = []
+    mockcmd = slurm.Waiter._cmd
+
+    def recordcmd(self, jobs, **kwargs):
+        asked.append(jobs)
+        return mockcmd(self, jobs, **kwargs)
+
+    monkeypatch.setattr(slurm.Waiter, '_cmd', recordcmd)
+    waiter = slurm.Waiter(list(map(str, list(range(1, 7)))), chunk_size=2)
+    waiter.query()
+
+    assert sorted(asked) == ['1,2', '3,4', '5,6']
+    assert waiter.unsuccessful_jobs() in (['2', '5'], ['5', '2'])
+    assert waiter.successful_jobs() == ['3']
+
+
+def test_slurm_waiter_array_tasks(monkeypatch):
+    now = datetime.utcnow().strftime(slurm.Waiter._time_format)
+    sacct_data = '\n'.join([
+        '10|COMPLETED|0:0|{0}|7_0',
+        '10.batch|COMPLETED|0:0|{0}|7_0.batch',
+        '11|FAILED|1:0|{0}|7_1',
+        '12|COMPLETED|0:0|{0}|7_2',
+        '9|COMPLETED|0:0|{0}|9',
+    ]).format(now)
+    asked = []
+
+    def mockcmd(self, jobs, **kwargs):
+        asked.append(jobs)
+        return FakeProcess(sacct_data)
+
+    monkeypatch.setattr(slurm.Waiter, '_cmd', mockcmd)
+    waiter = slurm.Waiter(['7_0', '7_1', '9'])
+    waiter.query()
+
+    assert asked == ['7,9']
+    assert waiter.successful_jobs() == ['7_0', '9']
+    assert waiter.unsuccessful_jobs() == ['7_1']
+    assert waiter.finished()
+
+
+def test_slurm_sacct_rows():
+    waiter = slurm.Waiter(['1', '2', '3_1'])
+    lines = [
+        '1|COMPLETED|0:0|2016-02-13T11:32:47\n',
+        '1.batch|COMPLETED|0:0|2016-02-13T11:32:47\n',
+        '1.extern|COMPLETED|0:0|2016-02-13T11:32:47\n',
+        '\n',
+        '4|FAILED|1:0|2099-01-01T00:00:00|3_1\n',
+    ]
+    assert list(waiter._rows(lines)) == [
+        ('1', 'COMPLETED', '0:0', '2016-02-13T11:32:47', None),
+        ('4', 'FAILED', '1:0', '2099-01-01T00:00:00', '3_1'),
+    ]
+    assert waiter._latest(lines) == {'3_1': ('FAILED', '1:0')}
+
+
+QSTAT_XML = '''<?xml version="1.0"?><Data>\
+<Job><Job_Id>1.server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+<Job><Job_Id>2.server</Job_Id><job_state>C</job_state><exit_status>271</exit_status></Job>\
+<Job><Job_Id>3.server</Job_Id><job_state>R</job_state></Job>\
+<Job><Job_Id>4[0].server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+<Job><Job_Id>4[1].server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+<Job><Job_Id>5[0].server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+<Job><Job_Id>5[1].server</Job_Id><job_state>Q</job_state></Job>\
+<Job><Job_Id>6[0].server</Job_Id><job_state>C</job_state><exit_status>1</exit_status></Job>\
+<Job><Job_Id>6[1].server</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+<Job><Job_Id>7.other</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>\
+</Data>'''
+
+
+@pytest.fixture
+def no_qstat(monkeypatch):
+    calls = []
+
+    def mockcmd(self, **kwargs):
+        calls.append(kwargs)
+        # hand the xml over in small pieces like a pipe would
+        return [QSTAT_XML[i:i + 7] for i in range(0, len(QSTAT_XML), 7)]
+
+    monkeypatch.setattr(pbs.Waiter, '_cmd', mockcmd)
+    return calls
+
+
+def test_pbs_waiter_jobstatus(no_qstat):
+    waiter = pbs.Waiter(['1.server', '2', '3.server', '4[1].server',
+                         '4[].server', '5[].server', '6[].server', '8'])
+    waiter.query()
+    assert len(no_qstat) == 1
+
+    assert sorted(waiter.successful_jobs()) == ['1.server', '4[1].server',
+                                                '4[].server']
+    # 8 is no longer listed, its history expired
+    assert sorted(waiter.unsuccessful_jobs()) == ['2', '6[].server', '8']
+    assert sorted(waiter.unfinished_jobs()) == ['3.server', '5[].server']
+    assert waiter._info['2'] == ('C', '271')
+    assert waiter._info['8'] == ('UNKNOWN', None)
+
+    waiter = pbs.Waiter(['1.server'], timeout=5)
+    start = time.time()
+    waiter.wait()
+    assert time.time() - start < 0.1
+    assert waiter.successful_jobs() == ['1.server']
+
+    pbs.Waiter([]).wait()
+    assert len(no_qstat) == 2
+
+
+def test_pbs_async_waiter(tmpdirs, monkeypatch):
+    script_dir, _ = tmpdirs
+    fp = Path(str(script_dir)).joinpath('qstat.xml')
+    fp.write_text(QSTAT_XML)
+    qstat = fake_command(script_dir, 'fake_qstat', 'cat {0}'.format(fp))
+    monkeypatch.setattr(pbs.AsyncWaiter, '_args', [qstat])
+
+    waiter = pbs.AsyncWaiter(['2.server', '6[].server'], timeout=5)
+    asyncio.run(waiter.wait())
+    assert sorted(waiter.unsuccessful_jobs()) == ['2.server', '6[].server']
+
+
+QSTAT_SGE_XML = '''<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running"><JB_job_number>11</JB_job_number><state>r</state></job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending"><JB_job_number>12</JB_job_number><state>qw</state></job_list>
+    <job_list state="pending"><JB_job_number>13</JB_job_number><state>Eqw</state></job_list>
+  </job_info>
+</job_info>
+'''
+
+
+def accounting_line(job, failed=0, exit_status=0, task=0):
+    fields = ['all.q', 'node1', 'grp', 'user', 'name', str(job), 'sge', '0',
+              '1', '2', '3', str(failed), str(exit_status)]
+    fields += ['0'] * 22 + [str(task)]
+    return ':'.join(fields) + '\n'
+
+
+@pytest.fixture
+def no_sge_qstat(monkeypatch):
+    xml = {'data': QSTAT_SGE_XML}
+
+    def mockcmd(self, **kwargs):
+        return [xml['data']]
+
+    monkeypatch.setattr(sge.Waiter, '_cmd', mockcmd)
+    return xml
+
+
+def test_sge_waiter_jobstatus(tmpdirs, no_sge_qstat):
+    script_dir, _ = tmpdirs
+    accounting = Path(str(script_dir)).joinpath('accounting')
+    accounting.write_text('# Version: 8.1\n' + accounting_line(9))
+
+    # 9 finished before anything waited on the file
+    waiter = sge.Waiter(['9', '10', '11', '12', '13', '14', '15'],
+                        accounting=accounting)
+    with open(accounting, 'a') as fh:
+        fh.write(accounting_line(10))
+    waiter.query()
+    assert '9' in waiter.unfinished_jobs()
+    assert waiter.successful_jobs() == ['10']
+    assert waiter.unsuccessful_jobs() == ['13']
+    assert waiter._info['12'] == ('qw', None)
+
+    # 11 leaves the queue, 14 is half written
+    no_sge_qstat['data'] = re.sub(r'<job_list state="running">.*</job_list>',
+                                  '', QSTAT_SGE_XML)
+    with open(accounting, 'a') as fh:
+        fh.write(accounting_line(11, exit_status=1))
+        fh.write(accounting_line(15, task=1))
+        fh.write(accounting_line(15, failed=100, task=2))
+        fh.write(accounting_line(14)[:20])
+    tail = sge.get_accounting_tail(accounting)
+    waiter.query()
+    assert sorted(waiter.unsuccessful_jobs()) == ['11', '13', '15']
+    assert '14' in waiter.unfinished_jobs()
+    assert tail.offset == accounting.size - 20
+
+    with open(accounting, 'a') as fh:
+        fh.write(accounting_line(14)[20:])
+    waiter.query()
+    assert '14' in waiter.successful_jobs()
+    assert tail.offset == accounting.size
+
+    # a rotated file is read from the start
+    accounting.remove()
+    accounting.write_text(accounting_line(16))
+    rotated = sge.Waiter(['16'], accounting=accounting, timeout=5).wait()
+    assert rotated.successful_jobs() == ['16']
+
+    # only jobs a Waiter tracks are indexed, until they finish
+    assert tail.index == {}
+    with open(accounting, 'a') as fh:
+        fh.write(accounting_line(17))
+        fh.write(accounting_line(18, exit_status=2))
+    tail.read()
+    assert tail.index == {}
+    late = sge.Waiter(['18'], accounting=accounting)
+    assert late.query().unsuccessful_jobs() == ['18']
+    assert tail.index == {}
+
+    with pytest.raises(ValueError):
+        sge.Waiter(['16'], accounting=None)
+
+
+def test_bash_executor(tmpdirs):
+    script_dir, log_dir = tmpdirs
+    submit = bash.Submitter(script=script_dir, log=log_dir)
+    executor = bash.get_executor()
+    out = Path(str(log_dir)).joinpath('order')
+
+    first = submit.submit_job('sleep 0.3; echo first >> {0}'.format(out),
+                              name='first')
+    second = submit.submit_job('echo second >> {0}'.format(out),
+                               name='second', hold='first')
+    failing = submit.submit_job('exit 3', name='failing')
+    cancelled = submit.submit_job('touch never', name='cancelled',
+                                  hold=['failing'])
+
+    infos = submit.submit_many(
+        [{'job': 'echo task{0}'.format(i), 'name': 'task{0}'.format(i)}
+         for i in range(3)],
+        resource=bash.Resource(workers=executor.cpus * 2, memInGB=0.001))
+    slow = submit.submit_job(
+        'sleep 5', resource=bash.Resource(time=timedelta(seconds=0.2)))
+
+    ids = [first.id, second.id, failing.id, cancelled.id, slow.id]
+    ids += [info.id for info in infos]
+    waiter = bash.Waiter(ids, timeout=10).wait()
+
+    assert sorted(waiter.successful_jobs()) == sorted(
+        [first.id, second.id] + [info.id for info in infos])
+    assert sorted(waiter.unsuccessful_jobs()) == sorted(
+        [failing.id, cancelled.id, slow.id])
+    assert waiter._info[failing.id] == (bash.FAILED, 3)
+    assert waiter._info[cancelled.id] == (bash.CANCELLED, None)
+    assert waiter._info[slow.id][0] == bash.TIMEOUT
+    assert out.text() == 'first\nsecond\n'
+    assert not Path.getcwd().joinpath('never').exists()
+
+    array_id = infos[0].id.split('_')[0]
+    assert executor.status(array_id) == bash.COMPLETED
+    for i, info in enumerate(infos):
+        log = Path(str(log_dir)).joinpath('array.{0}.{1}.stdout'.format(
+            array_id, i))
+        assert log.text() == 'task{0}\n'.format(i)
+
+
+def test_bash_admission():
+    executor = bash.LocalExecutor(cpus=2, memInGB=4)
+    running = []
+    for workers, mem in [(1, 1), (1, 1), (1, 1), (8, 1)]:
+        job = bash.LocalJob(id=str(len(running)), command=['true'],
+                            stdout=os.devnull, stderr=os.devnull,
+                            workDir='/', workers=min(executor.cpus, workers),
+                            memInGB=mem)
+        executor._add(job)
+        running.append(job)
+
+    executor._start = lambda job: (running.append(job.id),
+                                   setattr(executor, '_free_cpus',
+                                           executor._free_cpus - job.workers))
+    executor._schedule()
+    # two cpus, the third job and the whole machine job wait
+    assert running[4:] == ['0', '1']
+    assert list(executor._pending) == ['2', '3']
+
+
+def test_indexed_array(tmpdirs):
+    script_dir, log_dir = tmpdirs
+    submit = bash.Submitter(script=script_dir, log=log_dir)
+
+    jobs = ('echo task{0}'.format(i) for i in range(50))
+    array = submit.indexed_array(jobs, name='indexed')
+    array.add_job('echo "it\'s  $DRM_ARRAY_TASK_ID"\necho done')
+    assert len(array) == 51
+    assert array[3] == 'echo task3'
+    assert array[-1].endswith('echo done')
+
+    info = submit.submit_job(array, name='indexed')
+    array.close()
+    text = info.script.text()
+    assert 'task3' not in text and 'if [' not in text
+
+    bash.Waiter(info.id, timeout=30).wait()
+    assert bash.get_executor().status(info.id) == bash.COMPLETED
+    logs = Path(str(log_dir))
+    assert logs.joinpath('indexed.7.stdout').text() == 'task7\n'
+    assert logs.joinpath('indexed.50.stdout').text() == "it's  50\ndone\n"
+
+
+def test_submit_many_indexed(tmpdirs, monkeypatch):
+    import sh
+    script_dir, log_dir = tmpdirs
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'inline_array_limit', 2)
+
+    infos = submit.submit_many(['ls a', 'ls b', 'ls c'])
+    text = infos[0].script.text()
+    assert '--array=0-2' in text
+    assert '$SLURM_ARRAY_TASK_ID' in text and 'ls b' not in text
+
+    infos = submit.submit_many(['ls d', 'ls e'])
+    assert 'ls e' in infos[0].script.text()
+
+    # the task files are closed when submission fails
+    arrays = []
+
+    def indexed_array(jobs=(), name=None):
+        arrays.append(base.Submitter.indexed_array(submit, jobs, name))
+        return arrays[-1]
+
+    def fail(*args):
+        raise sh.ErrorReturnCode_1('sbatch', b'', b'')
+
+    monkeypatch.setattr(submit, 'indexed_array', indexed_array)
+    monkeypatch.setattr(submit, '_submit_array', fail)
+    with pytest.raises(sh.ErrorReturnCode):
+        submit.submit_many(['ls f', 'ls g', 'ls h'])
+    assert arrays[0]._tasks.closed and arrays[0]._index.closed
+
+
+@pytest.mark.parametrize('module,flag', [
+    (slurm, '--array=0-{0}%3'),
+    (pbs, '-t 0-{0}%3'),
+])
+def test_split_array(tmpdirs, monkeypatch, module, flag):
+    script_dir, log_dir = tmpdirs
+    submit = module.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'max_array_size', 2)
+
+    array = module.JobArray(['ls {0}'.format(i) for i in range(5)],
+                            throttle=3, chain=True)
+    info = submit.submit_job(array, name='big')
+    assert info.id == ['1', '2', '3']
+    assert len(info) == 5
+    assert info.task_id(4) == submit.array_task_id('3', 0)
+    assert info.task_id(-2) == submit.array_task_id('2', 1)
+
+    texts = [fp.text() for fp in info.scripts]
+    assert [flag.format(n) in t for t, n in zip(texts, [1, 1, 0])] == [True] * 3
+    assert 'ls 2' in texts[1] and 'ls 4' in texts[2]
+    assert 'afterok:1' in texts[1] and 'afterok:2' in texts[2]
+
+    # holding on the name holds on every part
+    after = submit.submit_job('ls', hold='big').script.text()
+    assert 'afterok:1:2:3' in after
+    assert sorted(submit.jobs) == ['1', '2', '3', '4']
+
+    # parts running side by side share the throttle
+    for throttle, shares in [(5, ['2', '2', '1']), (2, ['1', '1', '1'])]:
+        array = module.JobArray(['ls {0}'.format(i) for i in range(5)],
+                                throttle=throttle)
+        info = submit.submit_job(array)
+        assert [re.search(r'0-\d+%(\d+)', fp.text()).group(1)
+                for fp in info.scripts] == shares
+
+
+def test_split_indexed_array(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    submit = bash.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'max_array_size', 2)
+
+    # a task fails if another one is running, the throttle prevents that
+    lock = Path(str(script_dir)).joinpath('lock')
+    task = 'mkdir {0} && echo task{1} && sleep 0.05 && rmdir {0}'
+    array = submit.indexed_array(
+        (task.format(lock, i) for i in range(5)), name='split')
+    array.throttle = 1
+    array.chain = True
+    info = submit.submit_job(array, name='split')
+
+    bash.Waiter(info.ids, timeout=30).wait()
+    assert [bash.get_executor().status(i) for i in info.ids] == [
+        bash.COMPLETED] * 3
+    for i in range(5):
+        log = Path(str(log_dir)).joinpath('split.{0}.{1}.stdout'.format(
+            i // 2, i % 2))
+        assert log.text() == 'task{0}\n'.format(i)
+
+
+def test_array_size_limit(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    fake_command(script_dir, 'scontrol',
+                 'echo "MaxJobCount             = 10000"; '
+                 'echo "MaxArraySize            = 1001"')
+    monkeypatch.setenv('PATH', str(script_dir), prepend=os.pathsep)
+    base.scheduler_setting.cache_clear()
+
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    assert submit.array_size_limit() == 1001
+    monkeypatch.setattr(submit, 'max_array_size', 10)
+    assert submit.array_size_limit() == 10
+    assert pbs.Submitter(script=script_dir, log=log_dir).array_size_limit() is None
+    base.scheduler_setting.cache_clear()
+
+
+@pytest.mark.parametrize('archive', [False, True])
+def test_stdin_submit(tmpdirs, monkeypatch, archive):
+    script_dir, log_dir = tmpdirs
+    received = Path(str(script_dir)).joinpath('received')
+    cmd = fake_command(script_dir, 'fake_sbatch',
+                       'cat >> {0}; echo "Submitted batch job 42"'.format(
+                           received))
+    monkeypatch.setattr(slurm.Submitter, '_submit', base.Submitter._submit)
+    monkeypatch.setattr(slurm.Submitter, 'submit_cmd', cmd)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'stdin', True)
+    monkeypatch.setattr(submit, 'archive', archive)
+    before = set(os.listdir(str(script_dir)))
+
+    info = submit.submit_job('ls', name='piped')
+    other = submit.submit_job('echo other', hold='piped')
+    assert info.id == '42'
+    assert not os.path.exists(str(info.script))
+    assert '#SBATCH -J piped' in info.script.text()
+    assert received.text() == info.script.text() + other.script.text()
+
+    written = set(os.listdir(str(script_dir))) - before - {'received'}
+    if archive:
+        archive_fp = 'scripts-{0}.gz'.format(submit.uid)
+        assert written == {archive_fp, archive_fp + '.index'}
+        assert [name for name, text in submit._archive] == [
+            os.path.basename(str(info.script)),
+            os.path.basename(str(other.script))]
+    else:
+        assert not written
+
+    with submit:
+        submit.submit_job('echo last')
+    fds = '/proc/self/fd'
+    assert not [fd for fd in os.listdir(fds)
+                if 'scripts-' in os.path.realpath(os.path.join(fds, fd))]
+    assert '#SBATCH -J piped' in info.script.text()
+
+
+def test_bash_stdin_submit(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    submit = bash.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'stdin', True)
+    array = submit.array_class()
+    array.add_job('echo "it\'s a"')
+    array.add_job('echo b')
+
+    info = submit.submit_job(array, name='piped')
+    bash.Waiter(info.id, timeout=30).wait()
+    assert not os.listdir(str(script_dir))
+    logs = Path(str(log_dir))
+    assert logs.joinpath('piped.0.stdout').text() == "it's a\n"
+    assert logs.joinpath('piped.1.stdout').text() == 'b\n'
+
+
+def test_content_addressed_scripts(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    monkeypatch.setattr(slurm.Submitter, 'content_addressed', True)
+    first = slurm.Submitter(script=script_dir, log=log_dir)
+    second = slurm.Submitter(script=script_dir, log=log_dir)
+
+    a = first.submit_job('ls')
+    b = second.submit_job('ls')
+    c = second.submit_job('echo other')
+    array = second.array_class()
+    array.add_job('ls')
+    d = second.submit_job(array)
+    assert a.script == b.script != c.script
+    assert a.script.text() == b.script.text()
+    assert '#SBATCH --array=0-0' in d.script.text()
+    store = first.script_store()
+    assert len(store.root.glob('??/*')) == 3
+    assert store.refs()[a.script.name] == {a.id, b.id}
+    assert not [f for f in os.listdir(str(script_dir)) if f != 'store']
+
+    assert store.gc([a.id, b.id, c.id, d.id], min_age=0) == []
+    assert store.gc([b.id], min_age=3600) == []
+    assert sorted(store.gc([b.id], min_age=0)) == sorted([c.script, d.script])
+    assert os.path.exists(b.script)
+    assert store.refs() == {b.script.name: {b.id}}
+    # b was submitted by another driver and is not known to be finished
+    runs = registry.JobRegistry(store.root.joinpath('jobs.db'))
+    runs.record(None, b.id, 'other')
+    second.registry = runs
+    assert second.gc_scripts(min_age=0) == []
+    runs.close()
+    assert first.gc_scripts([], min_age=0) == [b.script]
+    with pytest.raises(ValueError):
+        first.gc_scripts()
+
+
+def test_submit_packed(tmpdirs):
+    script_dir, log_dir = tmpdirs
+    submit = bash.Submitter(script=script_dir, log=log_dir)
+    jobs = ['echo task{0}'.format(i) for i in range(9)]
+    jobs[7] = 'echo "it\'s  7"; exit 3'
+
+    info = submit.submit_packed(jobs, name='packed', pack_size=4,
+                                resource=bash.Resource(workers=2))
+    assert len(info) == 9 and len(info.ids) == 3
+    assert submit._JOB_NAME_TO_ID['packed'] == info.ids
+
+    bash.Waiter(info.id, timeout=30).wait()
+    assert [bash.get_executor().status(i) for i in info.ids] == [
+        bash.COMPLETED, bash.FAILED, bash.COMPLETED]
+    results = info.results()
+    assert sorted(results) == list(range(9)) and not info.unfinished()
+    assert info.failed() == [7] and results[7].exitcode == 3
+    assert all(r.elapsed >= 0 for r in results.values())
+    out = Path(str(log_dir)).joinpath('packed.1.stdout').text()
+    assert sorted(out.splitlines()) == ["it's  7", 'task4', 'task5', 'task6']
+    assert submit.submit_packed(['', '']) is None
+
+
+@pytest.mark.parametrize('module', [slurm, pbs, sge])
+def test_packed_script(tmpdirs, module):
+    script_dir, log_dir = tmpdirs
+    submit = module.Submitter(script=script_dir, log=log_dir)
+    info = submit.submit_packed(['ls', 'ls -l', 'pwd'], name='pk',
+                                resource=module.Resource(workers=3))
+    text = info.script.text()
+    assert 'xargs -0 -n 2 -P 3 ' in text
+    tasks = Path('{0}.tasks'.format(info.script)).bytes()
+    assert tasks.split(b'\0') == [b'0', b'ls', b'1', b'ls -l', b'2', b'pwd', b'']
+    assert info.unfinished() == [0, 1, 2]
+
+
+def test_governor_rate(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    monkeypatch.setattr(submit, 'governor', base.Governor(rate=50, burst=2))
+    start = time.monotonic()
+    for i in range(7):
+        submit.submit_job('ls')
+    # two jobs go in the burst, five wait 1/50s each
+    assert time.monotonic() - start >= 5 / 50
+
+
+def test_governor_retry(tmpdirs, monkeypatch):
+    import sh
+    script_dir, log_dir = tmpdirs
+    timeout = (b'sbatch: error: Batch job submission failed: '
+               b'Socket timed out on send/recv operation')
+    errors = []
+
+    def flakysubmit(self, fp):
+        if errors:
+            raise sh.ErrorReturnCode_1('sbatch', b'', errors.pop())
+        return FakeProcess('Submitted batch job 42')
+
+    monkeypatch.setattr(slurm.Submitter, '_submit', flakysubmit)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    errors[:] = [timeout]
+    with pytest.raises(sh.ErrorReturnCode):
+        submit.submit_job('ls', name='nogovernor')
+    assert 'nogovernor' not in submit._JOB_NAME_TO_ID
+
+    monkeypatch.setattr(submit, 'governor', base.Governor(
+        retries=2, policy=base.FixedInterval(0)))
+    errors[:] = [timeout] * 2
+    assert submit.submit_job('ls', name='retried').id == '42'
+    assert not errors
+
+    errors[:] = [timeout] * 3
+    with pytest.raises(sh.ErrorReturnCode):
+        submit.submit_job('ls')
+    assert not errors
+    errors[:] = [timeout, b'sbatch: error: invalid partition specified']
+    with pytest.raises(sh.ErrorReturnCode):
+        submit.submit_job('ls')
+    assert errors == [timeout]
+
+
+def test_governor_pending(tmpdirs, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    fake_command(script_dir, 'squeue', 'cat {0}'.format(
+        Path(str(script_dir)).joinpath('queue')))
+    monkeypatch.setenv('PATH', str(script_dir), prepend=os.pathsep)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    Path(str(script_dir)).joinpath('queue').write_text('7_1\n7_2\n8\n')
+    assert submit.pending_jobs() == 3
+
+    counts = [5, 4, 1, 3]
+    queried = []
+
+    def pending_jobs():
+        queried.append(len(queried))
+        return counts.pop(0)
+
+    monkeypatch.setattr(submit, 'pending_jobs', pending_jobs)
+    monkeypatch.setattr(submit, 'governor', base.Governor(
+        max_pending=4, pending_policy=base.FixedInterval(0)))
+    for i in range(4):
+        submit.submit_job('ls')
+    # 5 and 4 pending leave no room, 1 leaves room for 3 jobs
+    assert len(queried) == 4 and counts == []
+
+
+def test_metrics(tmpdirs, no_query, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    monkeypatch.setattr(metrics, 'HOOKS', [])
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    # not recorded, no hooks are installed yet
+    submit.submit_job('ls', resource=slurm.Resource(memInGB=3))
+
+    registry = metrics.enable()
+    submit.submit_job('ls', resource=slurm.Resource(memInGB=4))
+    submit.submit_job('ls', resource=slurm.Resource(memInGB=4))
+    slurm.Waiter(['1', '5'], timeout=1).query()
+    assert registry.counters == {'submissions': 2}
+    for name in ['submit_job', 'render_script', 'write_script']:
+        assert registry.histogram('latency', name).count == 2
+    assert registry.histogram('latency', 'render_resource').count == 1
+    assert registry.histogram('latency', 'poll').count == 1
+    assert registry.histogram('size', 'poll_lines').sum == 2
+
+    text = registry.prometheus()
+    assert 'drm_submissions_total 2\n' in text
+    assert 'drm_submit_job_seconds_bucket{le="+Inf"} 2\n' in text
+    assert 'drm_poll_lines_bucket{le="10"} 1\n' in text
+    json_fp = Path(str(log_dir)).joinpath('metrics.json')
+    registry.write_json(json_fp)
+    data = json.loads(json_fp.text())
+    assert data['counters'] == {'drm_submissions_total': 2}
+    assert data['histograms']['drm_poll_seconds']['count'] == 1
+
+
+def test_job_registry(tmpdirs, no_query, monkeypatch, new_process):
+    script_dir, log_dir = tmpdirs
+    db = Path(str(script_dir)).joinpath('jobs.db')
+    jobs = registry.JobRegistry(db, batch_size=3, max_delay=60)
+    monkeypatch.setattr(slurm.Submitter, 'registry', jobs)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    # another process only sees committed batches
+    other = registry.JobRegistry(db)
+    a = submit.submit_job('ls', name='a')
+    submit.submit_job('ls')
+    assert other.jobs() == []
+    monkeypatch.setattr(submit, 'max_array_size', 1)
+    array = submit.array_class(['ls', 'ls'])
+    split = submit.submit_job(array, name='split')
+    assert len(other.jobs()) == 4
+
+    # a lone job is written after max_delay without another record
+    timed = registry.JobRegistry(db, max_delay=0.05)
+    timed.record('lone', '99', 'run')
+    deadline = time.time() + 5
+    while not other.jobs(run='run') and time.time() < deadline:
+        time.sleep(0.01)
+    assert other.jobs(run='run')[0][:2] == ('lone', '99')
+    timed.close()
+    other.close()
+
+    jobs.update_from(slurm.Waiter(split.ids, timeout=0).query())
+    assert [r[:4] for r in jobs.jobs(state=registry.COMPLETED)] == [
+        ('split', split.ids[0], submit.uid, registry.COMPLETED)]
+    jobs.close()
+
+    # a new process knows nothing until it restores from the database
+    new_process(slurm)
+    monkeypatch.setattr(slurm.Submitter, 'registry', None)
+    monkeypatch.setenv('DRM_REGISTRY', str(db))
+    monkeypatch.setattr(base, 'REGISTRY_PATH', str(db))
+    restarted = slurm.Submitter(script=script_dir, log=log_dir)
+    assert restarted.registry is registry.shared(str(db))
+    assert sorted(restarted.restore()) == ['a', 'lone', 'split']
+    assert restarted._JOB_NAME_TO_ID == {
+        'a': a.id, 'split': split.ids, 'lone': '99'}
+    assert len(restarted._NO_NAME_JOBS) == 1
+
+    info = restarted.submit_job('ls', name='b', hold=['a', 'split'])
+    assert '#SBATCH -d afterok:{0}\n'.format(':'.join(
+        [a.id] + split.ids)) in info.script.text()
+    with pytest.raises(RuntimeError):
+        restarted.submit_job('ls', name='a')
+    restarted.registry.flush()
+    assert restarted.registry.mappings(restarted.uid)[0] == {'b': info.id}
+    assert restarted.registry is not jobs
+    # WAL mode is kept in the database file
+    import sqlite3
+    mode = sqlite3.connect(str(db)).execute('PRAGMA journal_mode').fetchone()
+    assert mode == ('wal', )
+    restarted.registry.close()
+    registry.shared.cache_clear()
+
+
+def test_incremental(tmpdirs, monkeypatch, new_process):
+    script_dir, log_dir = tmpdirs
+    work = Path(str(log_dir))
+    source, middle, final = [work.joinpath(f) for f in ['in', 'mid', 'out']]
+    source.write_text('x')
+    monkeypatch.setattr(bash.Submitter, 'incremental', True)
+
+    def run():
+        new_process(bash)
+        submit = bash.Submitter(script=script_dir, log=log_dir)
+        a = submit.submit_job('cat {0} {0} > {1}'.format(source, middle),
+                              name='a', inputs=[source], outputs=[middle])
+        b = submit.submit_job('cat {0} {0} > {1}'.format(middle, final),
+                              name='b', hold='a', inputs=[middle],
+                              outputs=[final])
+        c = submit.submit_job('exit 1', name='c', hold='b')
+        # exits before the end of the script
+        d = submit.submit_job('exit 0', name='d')
+        bash.Waiter([i.id for i in [a, b, c, d]], timeout=30).wait()
+        return submit, a, b, c, d
+
+    submit, a, b, c, d = run()
+    assert final.text() == 'xxxx'
+    assert not isinstance(c, base.SkippedJobInfo)
+
+    submit, a2, b2, c2, d2 = run()
+    assert isinstance(a2, base.SkippedJobInfo)
+    assert isinstance(d2, base.SkippedJobInfo)
+    assert (a2.id, a2.script, b2.id) == (a.id, a.script, b.id)
+    assert a2.script.text() == a.script.text()
+    assert None not in submit.jobs and a.id not in submit.jobs
+    with pytest.raises(RuntimeError):
+        submit.submit_job('ls', name='a')
+    # failed before, runs again without holding on the skipped b
+    assert not isinstance(c2, base.SkippedJobInfo)
+    assert '#DRM -d' not in c2.script.text()
+
+    # a newer input reruns a, and b because it holds on a
+    source.write_text('y')
+    earlier = os.path.getmtime(source) - 10
+    for output in [middle, final]:
+        os.utime(output, (earlier, earlier))
+    submit, a3, b3, c3, d3 = run()
+    assert not isinstance(a3, base.SkippedJobInfo)
+    assert not isinstance(b3, base.SkippedJobInfo)
+    assert final.text() == 'yyyy'
+
+    final.remove()
+    submit, a4, b4, c4, d4 = run()
+    assert isinstance(a4, base.SkippedJobInfo)
+    assert not isinstance(b4, base.SkippedJobInfo) and final.exists()
+
+
+def test_incremental_waiter(tmpdirs, no_query, monkeypatch, new_process):
+    script_dir, log_dir = tmpdirs
+    monkeypatch.setattr(slurm.Submitter, 'incremental', True)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    first = submit.submit_job('ls', name='x')
+
+    class Done(object):
+        def successful_jobs(self):
+            return [first.id]
+
+    submit.record_success(Done())
+
+    new_process(slurm)
+    submit = slurm.Submitter(script=script_dir, log=log_dir)
+    skipped = submit.submit_job('ls', name='x')
+    held = submit.submit_job('ls', name='y', hold='x')
+    assert isinstance(skipped, base.SkippedJobInfo)
+    assert '#SBATCH -d' not in held.script.text()
+    # the skipped job has no id to wait on
+    assert submit.jobs == [held.id]
+    waiter = slurm.Waiter(submit.jobs).query()
+    assert waiter.finished()
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def slurmrestd(request, tmpdirs):
+    '''
+    A fake slurmrestd: submissions are kept in server.submitted, /jobs
+    answers server.states and slurmdbd server.accounting[jobid], an
+    error if that is a status.  With
+    server.drop set the next submission is kept but never answered.
+    '''
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def do_GET(self):
+            if self.path.startswith('/slurmdb/v0.0.39/job/'):
+                jobs = self.server.accounting.get(
+                    self.path.rsplit('/', 1)[1], [])
+                if isinstance(jobs, int):
+                    return self.reply({'errors': [{'error': 'down'}]}, jobs)
+                return self.reply({'jobs': jobs, 'errors': []})
+            assert self.path == '/slurm/v0.0.39/jobs'
+            self.reply({'jobs': self.server.states, 'errors': []})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(
+                int(self.headers['Content-Length'])))
+            assert self.path == '/slurm/v0.0.39/job/submit'
+            assert self.headers['X-SLURM-USER-TOKEN'] == 'token'
+            if body['job'].get('name') == 'rejected':
+                return self.reply({'errors': [{'error': 'bad'}]}, 500)
+            self.server.submitted.append(body)
+            if self.server.drop:
+                self.server.drop = False
+                self.close_connection = True
+                return
+            self.reply({'job_id': 100 + len(self.server.submitted),
+                        'errors': []})
+
+        def reply(self, data, status=200):
+            payload = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+        def address_string(self):
+            return 'client'
+
+    if request.param == 'tcp':
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    else:
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        path = str(Path(str(tmpdirs[0])).joinpath('slurmrestd.socket'))
+        server = Server(path, Handler)
+        url = 'unix://' + path
+    server.connections = 0
+    server.submitted = []
+    server.states = []
+    server.accounting = {}
+    server.drop = False
+    server.client = slurmrest.RestClient(url, token='token')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_slurmrest_submit(tmpdirs, slurmrestd, monkeypatch):
+    script_dir, log_dir = tmpdirs
+    monkeypatch.setattr(slurmrest.Submitter, 'client', slurmrestd.client)
+    submit = slurmrest.Submitter(script=script_dir, log=log_dir)
+
+    resource = slurmrest.Resource(memInGB=2, workers=4,
+                                  time=timedelta(hours=2))
+    infos = [submit.submit_job('ls', name='rest{0}'.format(i),
+                               resource=resource) for i in range(5)]
+    held = submit.submit_job('ls', hold=['rest0', 'rest1'])
+    assert [i.id for i in infos] == ['101', '102', '103', '104', '105']
+    assert slurmrestd.connections == 1
+
+    body = slurmrestd.submitted[0]
+    assert body['script'] == infos[0].script.text()
+    job = body['job']
+    assert (job['name'], job['time_limit'], job['memory_per_node'],
+            job['cpus_per_task']) == ('rest0', 120, 2000, 4)
+    assert job['current_working_directory'] == os.getcwd()
+    assert job['standard_output'].endswith('rest0.o%j')
+    assert 'PATH={0}'.format(os.environ['PATH']) in job['environment']
+    assert slurmrestd.submitted[-1]['job']['dependency'] == 'afterok:101:102'
+
+    array = submit.array_class(['ls', 'pwd'], throttle=1)
+    submit.submit_job(array, name='array')
+    assert slurmrestd.submitted[-1]['job']['array'] == '0-1%1'
+    with pytest.raises(slurmrest.SlurmRestError):
+        submit.submit_job('ls', name='rejected')
+
+    slurmrestd.states = [
+        {'job_id': 101, 'job_state': 'COMPLETED', 'exit_code': 0},
+        {'job_id': 102, 'job_state': ['FAILED'],
+         'exit_code': {'status': 'ERROR', 'return_code': 1}},
+        {'job_id': {'set': True, 'number': 108}, 'job_state': ['COMPLETED'],
+         'array_job_id': {'set': True, 'number': 107},
+         'array_task_id': {'set': True, 'number': 1}},
+        {'job_id': 103, 'job_state': 'RUNNING'},
+    ]
+    waiter = slurmrest.Waiter(['101', '102', '103', '107_1'],
+                              client=slurmrestd.client).query()
+    assert waiter.successful_jobs() == ['101', '107_1']
+    assert waiter.unsuccessful_jobs() == ['102']
+    assert waiter.unfinished_jobs() == ['103']
+    assert slurmrestd.connections == 1
+
+
+def test_slurmrest_aged_out(slurmrestd):
+    # 201 and 202_0 left slurmctld, slurmdbd only knows 201
+    slurmrestd.accounting['201'] = [
+        {'job_id': 201, 'state': {'current': 'COMPLETED'},
+         'exit_code': {'return_code': 0},
+         'array': {'job_id': 0, 'task_id': None}},
+    ]
+    waiter = slurmrest.Waiter(['201', '202_0'],
+                              client=slurmrestd.client).query()
+    assert waiter.successful_jobs() == ['201']
+    assert waiter.unsuccessful_jobs() == ['202_0']
+    assert waiter.unfinished_jobs() == []
+
+    # slurmdbd failing is retried next poll, not taken as no record
+    slurmrestd.accounting['203'] = 503
+    waiter = slurmrest.Waiter(['203'], client=slurmrestd.client).query()
+    assert waiter.unfinished_jobs() == ['203']
+    slurmrestd.accounting['203'] = [
+        {'job_id': 203, 'state': {'current': 'COMPLETED'},
+         'exit_code': {'return_code': 0}},
+    ]
+    assert waiter.query().successful_jobs() == ['203']
+
+
+def test_slurmrest_retry(slurmrestd):
+    client = slurmrestd.client
+    client.jobs()
+
+    # a submission lost on a reused connection is not sent again
+    slurmrestd.drop = True
+    with pytest.raises((http_client.HTTPException, OSError)):
+        client.submit('#!/bin/bash\nls', {'name': 'once'})
+    assert len(slurmrestd.submitted) == 1
+
+    # closed idle connections are replaced before sending
+    assert client.submit('#!/bin/bash\nls', {'name': 'twice'}) == '102'
+    client.jobs()
+    conn = client._idle.get()
+    conn.sock.shutdown(socket.SHUT_WR)
+    # the server closes its end in turn
+    select.select([conn.sock], [], [], 5)
+    client._idle.put(conn)
+    assert client.submit('#!/bin/bash\nls', {'name': 'last'}) == '103'
+    assert len(slurmrestd.submitted) == 3